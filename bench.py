@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+
+# Benchmarks of check.py on synthetic backups.
+#
+# Each backup kind is benchmarked in its own process, on generated data:
+# a big file, a glob with many matches, a directory with many entries, a
+# git repository, a bucket with many keys in a local s3 stand-in (moto),
+# and files accessed over ssh. For each kind, the wall time, processes
+# forked, read/write syscalls, bytes read and peak memory are recorded, and
+# written as json so that results of two revisions can be compared:
+#
+#   bench.py run --scale small --output before.json
+#   (change check.py)
+#   bench.py run --scale small --output after.json
+#   bench.py compare before.json after.json
+#
+# s3 kinds need moto (pip install "moto<2"), and are skipped without it.
+# ssh kinds need --ssh-host, a host accepting ssh connections of the
+# current user with its keys and seeing the same filesystem, typically
+# localhost running sshd. With --strace, all syscalls are counted with
+# strace -c, which slows the run down.
+#
+# Generated data is kept in the work directory and reused by later runs.
+
+import os
+import sys
+import json
+import time
+import yaml
+import shutil
+import random
+import resource
+import argparse
+import tempfile
+import subprocess
+
+SCALES = {
+  "tiny":  {"file_size": 8*2**20,  "glob_matches": 200,    "dir_entries": 2000,    "git_commits": 50,    "s3_keys": 100,    "ssh_files": 5},
+  "small": {"file_size": 256*2**20, "glob_matches": 10000,  "dir_entries": 100000,  "git_commits": 1000,  "s3_keys": 2000,   "ssh_files": 50},
+  "large": {"file_size": 4*2**30,  "glob_matches": 100000, "dir_entries": 1000000, "git_commits": 20000, "s3_keys": 100000, "ssh_files": 150},
+}
+KINDS = ["file", "fileglob", "directory", "git", "s3_file", "s3_fileglob", "ssh_file", "ssh_dir"]
+ENTRIES_PER_DIR = 1000
+
+################################################################################
+# Generation of data. Each function returns the backup entries of the
+# config benchmarking its kind.
+
+# random data written repeatedly to the files generated
+RANDOM_BLOCK = os.urandom(2**20)
+
+def write_file(path, size):
+  f = open(path, "wb")
+  while size > 0:
+    f.write(RANDOM_BLOCK[:min(size, len(RANDOM_BLOCK))])
+    size -= len(RANDOM_BLOCK)
+  f.close()
+
+# call f to generate data in directory path, unless it was done already
+def generate_once(path, f):
+  done = os.path.join(path, ".generated")
+  if not os.path.exists(done):
+    if os.path.exists(path):
+      shutil.rmtree(path)
+    os.makedirs(path)
+    f(path)
+    open(done, "w").close()
+  return path
+
+def file_workload(workdir, scale):
+  path = generate_once(os.path.join(workdir, "file"), lambda d: write_file(os.path.join(d, "backup.tgz"), scale["file_size"]))
+  return [{"name": "big file", "kind": "file", "location": os.path.join(path, "backup.tgz"),
+           "tests": {"minsize": "1Kb", "filetype": "application/octet-stream", "md5": "0", "sha1": "0"}}]
+
+def fileglob_workload(workdir, scale):
+  def generate(d):
+    for i in range(scale["glob_matches"]):
+      write_file(os.path.join(d, "dump.%08d.sql.gz"%i), 1024)
+  path = generate_once(os.path.join(workdir, "fileglob"), generate)
+  return [{"name": "many matches", "kind": "fileglob", "location": os.path.join(path, "dump.*.sql.gz"),
+           "tests": {"count": scale["glob_matches"], "minsize": "1Kb", "filetype": "application/octet-stream"}}]
+
+def generate_tree(d, entries):
+  for i in range(entries):
+    subdir = os.path.join(d, "%05d"%(i/ENTRIES_PER_DIR))
+    if i%ENTRIES_PER_DIR == 0:
+      os.mkdir(subdir)
+    open(os.path.join(subdir, "%08d"%i), "w").write("x"*(i%4096))
+
+def directory_workload(workdir, scale):
+  path = generate_once(os.path.join(workdir, "directory"), lambda d: generate_tree(d, scale["dir_entries"]))
+  return [{"name": "many entries", "kind": "directory", "location": path,
+           "tests": {"minsize": "1Kb", "min_entries_count": 1,
+                     "directory_newest_entry_max_age": {"max_age": 10**9, "depth": 1}}}]
+
+def git_workload(workdir, scale):
+  # commits are generated with git fast-import, much faster than git commit
+  def generate(d):
+    subprocess.check_call(["git", "init", "-q", d])
+    subprocess.check_call(["git", "symbolic-ref", "HEAD", "refs/heads/master"], cwd=d)
+    stream = []
+    for i in range(scale["git_commits"]):
+      content = "commit %d\n"%i
+      message = "commit %d"%i
+      stream.append("commit refs/heads/master\ncommitter bench <bench@example.com> %d +0000\ndata %d\n%s\n"%(1400000000+i, len(message), message))
+      stream.append("M 644 inline file%d\ndata %d\n%s\n"%(i%100, len(content), content))
+    p = subprocess.Popen(["git", "fast-import", "--quiet"], cwd=d, stdin=subprocess.PIPE)
+    p.communicate("".join(stream))
+    if p.returncode != 0:
+      raise Exception("git fast-import failed")
+    subprocess.check_call(["git", "reset", "-q", "--hard"], cwd=d)
+  path = generate_once(os.path.join(workdir, "git"), generate)
+  return [{"name": "git repository", "kind": "git", "location": path, "tests": {"max_age": 10**10}}]
+
+def s3_auth(workdir):
+  path = os.path.join(workdir, "s3_auth.yml")
+  open(path, "w").write(yaml.dump({"access_key": "bench", "secret_key": "bench"}))
+  return path
+
+# the bucket is created in the benchmark process, as moto keeps it in memory
+def s3_fixture(scale):
+  import boto
+  conn = boto.connect_s3("bench", "bench")
+  bucket = conn.create_bucket("bench-backups")
+  data = os.urandom(4096)
+  for i in range(scale["s3_keys"]):
+    bucket.new_key("dump.%08d.sql.gz"%i).set_contents_from_string(data)
+  bucket.new_key("other.%08d"%0).set_contents_from_string(data)
+
+def s3_file_workload(workdir, scale):
+  return [{"name": "s3 file %d"%i, "kind": "s3_file", "s3_auth": s3_auth(workdir),
+           "location": "bench-backups/dump.%08d.sql.gz"%i, "tests": {"minsize": "1Kb"}}
+          for i in range(0, scale["s3_keys"], max(1, scale["s3_keys"]/100))]
+
+def s3_fileglob_workload(workdir, scale):
+  return [{"name": "s3 glob", "kind": "s3_fileglob", "s3_auth": s3_auth(workdir),
+           "location": "bench-backups/dump.*.sql.gz", "tests": {"count": scale["s3_keys"], "minsize": "1Kb"}},
+          {"name": "s3 glob prefix", "kind": "s3_fileglob", "s3_auth": s3_auth(workdir),
+           "location": "bench-backups/dump.0000000*.sql.gz", "tests": {"minsize": "1Kb"}}]
+
+def ssh_file_workload(workdir, scale, host, user):
+  def generate(d):
+    for i in range(scale["ssh_files"]):
+      write_file(os.path.join(d, "backup.%04d.tgz"%i), 2**20)
+  path = generate_once(os.path.join(workdir, "ssh_file"), generate)
+  return [{"name": "ssh file %d"%i, "kind": "ssh_file", "ssh_user": user,
+           "location": "%s:%s"%(host, os.path.join(path, "backup.%04d.tgz"%i)),
+           "tests": {"minsize": "1Kb", "md5": "0", "sha1": "0"}}
+          for i in range(scale["ssh_files"])]
+
+def ssh_dir_workload(workdir, scale, host, user):
+  path = generate_once(os.path.join(workdir, "ssh_dir"), lambda d: generate_tree(d, scale["dir_entries"]/10))
+  return [{"name": "ssh dir", "kind": "ssh_dir", "ssh_user": user, "location": "%s:%s"%(host, path),
+           "tests": {"minsize": "1Kb", "min_entries_count": 1}}]
+
+################################################################################
+# Measures, done in a child process per kind
+
+def proc_io():
+  try:
+    return dict((k, int(v)) for k,v in (l.split(":") for l in open("/proc/self/io")))
+  except IOError:
+    return {}
+
+def measure(config_file, kind, scale):
+  forks = [0]
+  original_popen = subprocess.Popen
+  class CountingPopen(original_popen):
+    def __init__(self, *args, **kwargs):
+      forks[0] += 1
+      original_popen.__init__(self, *args, **kwargs)
+  subprocess.Popen = CountingPopen
+
+  mock = None
+  if kind.startswith("s3_"):
+    from moto import mock_s3_deprecated
+    mock = mock_s3_deprecated()
+    mock.start()
+    s3_fixture(scale)
+
+  sys.argv = ["check.py", config_file]
+  import check
+  io_before = proc_io()
+  start = time.time()
+  bc = check.BackupChecker(config_file)
+  bc.check()
+  bc.cleanup()
+  wall = time.time() - start
+  io_after = proc_io()
+  if mock:
+    mock.stop()
+
+  statuses = {}
+  for b in bc.backups:
+    statuses[b.status] = statuses.get(b.status, 0) + 1
+  usage = resource.getrusage(resource.RUSAGE_SELF)
+  children = resource.getrusage(resource.RUSAGE_CHILDREN)
+  return {
+    "kind": kind,
+    "backups": len(bc.backups),
+    "statuses": statuses,
+    "wall_seconds": wall,
+    "cpu_seconds": usage.ru_utime + usage.ru_stime,
+    "children_cpu_seconds": children.ru_utime + children.ru_stime,
+    "forks": forks[0],
+    "read_syscalls": io_after.get("syscr", 0) - io_before.get("syscr", 0),
+    "write_syscalls": io_after.get("syscw", 0) - io_before.get("syscw", 0),
+    "bytes_read": io_after.get("rchar", 0) - io_before.get("rchar", 0),
+    "disk_bytes_read": io_after.get("read_bytes", 0) - io_before.get("read_bytes", 0),
+    # kilobytes on linux
+    "peak_rss_kb": usage.ru_maxrss,
+  }
+
+# total number of syscalls in the output of strace -c
+def strace_total(path):
+  for line in open(path):
+    if line.strip().endswith("total"):
+      fields = line.split()
+      return int(fields[3])
+  return None
+
+def run_kind(kind, entries, args, scale):
+  config_file = os.path.join(args.workdir, "bench_%s.yml"%kind)
+  config = {"settings": {"notifications": {"mail_on_error": False}}, "backups": entries}
+  if args.settings:
+    config["settings"].update(yaml.safe_load(open(args.settings)))
+  open(config_file, "w").write(yaml.safe_dump(config, default_flow_style=False))
+  here = os.path.dirname(os.path.abspath(__file__))
+  command = [sys.executable, os.path.abspath(__file__), "measure", "--scale", args.scale, kind, config_file]
+  strace_file = None
+  if args.strace:
+    strace_file = tempfile.mktemp()
+    command = ["strace", "-f", "-c", "-o", strace_file] + command
+  output = subprocess.Popen(command, cwd=here, stdout=subprocess.PIPE).communicate()[0]
+  result = json.loads(output.splitlines()[-1])
+  if strace_file:
+    result["syscalls"] = strace_total(strace_file)
+    os.unlink(strace_file)
+  return result
+
+def revision():
+  here = os.path.dirname(os.path.abspath(__file__))
+  try:
+    return subprocess.Popen(["git", "describe", "--always", "--dirty"], cwd=here, stdout=subprocess.PIPE).communicate()[0].strip()
+  except OSError:
+    return None
+
+def run(args):
+  scale = SCALES[args.scale]
+  if not os.path.isdir(args.workdir):
+    os.makedirs(args.workdir)
+  kinds = args.kinds.split(",") if args.kinds else KINDS
+  workloads = {
+    "file": lambda: file_workload(args.workdir, scale),
+    "fileglob": lambda: fileglob_workload(args.workdir, scale),
+    "directory": lambda: directory_workload(args.workdir, scale),
+    "git": lambda: git_workload(args.workdir, scale),
+    "s3_file": lambda: s3_file_workload(args.workdir, scale),
+    "s3_fileglob": lambda: s3_fileglob_workload(args.workdir, scale),
+    "ssh_file": lambda: ssh_file_workload(args.workdir, scale, args.ssh_host, args.ssh_user),
+    "ssh_dir": lambda: ssh_dir_workload(args.workdir, scale, args.ssh_host, args.ssh_user),
+  }
+  results = []
+  for kind in kinds:
+    if kind.startswith("s3_"):
+      try:
+        from moto import mock_s3_deprecated
+      except ImportError:
+        sys.stderr.write("skipping %s: moto not installed\n"%kind)
+        continue
+    if kind.startswith("ssh_") and not args.ssh_host:
+      sys.stderr.write("skipping %s: no --ssh-host\n"%kind)
+      continue
+    sys.stderr.write("%s...\n"%kind)
+    results.append(run_kind(kind, workloads[kind](), args, scale))
+  report = {"revision": revision(), "scale": args.scale, "date": time.strftime("%Y-%m-%d %H:%M:%S"), "results": results}
+  output = json.dumps(report, indent=2, sort_keys=True)
+  if args.output:
+    open(args.output, "w").write(output+"\n")
+  else:
+    print(output)
+
+METRICS = ["wall_seconds", "forks", "syscalls", "read_syscalls", "bytes_read", "peak_rss_kb"]
+def compare(args):
+  before = json.load(open(args.before))
+  after = json.load(open(args.after))
+  after_results = dict((r["kind"], r) for r in after["results"])
+  print("%-12s %-15s %15s %15s %8s"%("kind", "metric", before["revision"], after["revision"], "ratio"))
+  for b in before["results"]:
+    a = after_results.get(b["kind"])
+    if a is None:
+      continue
+    for metric in METRICS:
+      if b.get(metric) is None or a.get(metric) is None:
+        continue
+      ratio = "%.2f"%(float(a[metric])/b[metric]) if b[metric] else "-"
+      print("%-12s %-15s %15s %15s %8s"%(b["kind"], metric, b[metric], a[metric], ratio))
+
+def main():
+  parser = argparse.ArgumentParser(description="Benchmarks of check.py on synthetic backups")
+  commands = parser.add_subparsers(dest="command")
+  run_parser = commands.add_parser("run")
+  run_parser.add_argument("--scale", choices=sorted(SCALES), default="small")
+  run_parser.add_argument("--kinds", help="comma separated kinds, default all: "+",".join(KINDS))
+  run_parser.add_argument("--workdir", default=os.path.join(tempfile.gettempdir(), "backup_checker_bench"))
+  run_parser.add_argument("--settings", help="yaml file with settings for the configs, eg concurrency")
+  run_parser.add_argument("--ssh-host")
+  run_parser.add_argument("--ssh-user", default=os.environ.get("USER"))
+  run_parser.add_argument("--strace", action="store_true")
+  run_parser.add_argument("--output")
+  compare_parser = commands.add_parser("compare")
+  compare_parser.add_argument("before")
+  compare_parser.add_argument("after")
+  measure_parser = commands.add_parser("measure")
+  measure_parser.add_argument("--scale", choices=sorted(SCALES), default="small")
+  measure_parser.add_argument("kind")
+  measure_parser.add_argument("config")
+  args = parser.parse_args()
+
+  if args.command == "run":
+    run(args)
+  elif args.command == "compare":
+    compare(args)
+  else:
+    print(json.dumps(measure(args.config, args.kind, SCALES[args.scale])))
+
+if __name__ == "__main__":
+  main()
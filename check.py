@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 from Cheetah.Template import Template
+from Cheetah.Version import Version as CheetahVersion
 import os.path
 import humanfriendly
 import subprocess
@@ -8,6 +9,14 @@ import yaml
 import sys
 import time
 import hashlib
+import io
+import threading
+import collections
+import json
+from contextlib import contextmanager
+import importlib
+import imp
+import py_compile
 
 # The hierarchy of objects is:
 # backup ----< validators ----< tests
@@ -16,6 +25,451 @@ import hashlib
 # test characteristichs of the file, but not its content.
 # a mysql validator could possibly work on the content.
 
+################################################################################
+# Modules needed only by some kinds of backups (boto for s3, paramiko for
+# ssh) or for notifications are imported when first used, so that a config
+# checking only local backups does not pay for importing them.
+class LazyModule:
+  def __init__(self, name):
+    self.name = name
+    self.module = None
+  def __getattr__(self, attribute):
+    if self.module is None:
+      self.module = importlib.import_module(self.name)
+    return getattr(self.module, attribute)
+
+# Templates (the config and the report) are compiled by Cheetah to python
+# modules, kept in a .backup_checker_templates directory next to the
+# template and named after a digest of its source, so that a template is
+# compiled again only when modified. They are kept byte compiled.
+# If the directory cannot be written, templates are compiled in memory.
+def render_template(path, searchList=None):
+  return load_template(path, searchList).__str__()
+
+# returns the template instance, whose #def blocks can be rendered separately
+def load_template(path, searchList=None):
+  source = open(path).read()
+  name = "backup_checker_template_" + hashlib.sha1(CheetahVersion + source).hexdigest()
+  directory = os.path.join(os.path.dirname(os.path.abspath(path)), ".backup_checker_templates")
+  module_path = os.path.join(directory, name + ".py")
+  try:
+    if name not in sys.modules:
+      if not os.path.exists(module_path + "c"):
+        code = Template.compile(source=source, returnAClass=False, moduleName=name, className="CompiledTemplate")
+        if not os.path.isdir(directory):
+          os.makedirs(directory)
+        # the source is kept for tracebacks
+        f = open(module_path, "w")
+        f.write(code)
+        f.close()
+        tmp_path = "%s.%d.tmp"%(module_path, os.getpid())
+        py_compile.compile(module_path, tmp_path, doraise=True)
+        os.rename(tmp_path, module_path + "c")
+      imp.load_compiled(name, module_path + "c")
+    klass = sys.modules[name].CompiledTemplate
+  except (IOError, OSError):
+    klass = Template.compile(source=source)
+  return klass(searchList=searchList)
+
+################################################################################
+# Instrumentation records, for each backup, the time spent and the I/O done
+# by each phase: construction, exists, each spec provider and each test.
+# Phases are nested (eg a spec is computed during a test), and a phase's
+# measures include those of the phases it contains.
+# Bytes read are counted by the functions reading files in process, and
+# processes by run_command. I/O done in a batch for multiple backups is
+# accounted to the backup that triggered it.
+# Measures can be written as json lines and as a prometheus textfile:
+#   instrumentation:
+#     jsonl: /var/log/backup_checker/measures.jsonl
+#     prometheus: /var/lib/node_exporter/textfile/backup_checker.prom
+class Instrumentation:
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.local = threading.local()
+    self.records = []
+
+  # stack of phases being measured in the current thread
+  def stack(self):
+    if not hasattr(self.local, "stack"):
+      self.local.stack = []
+    return self.local.stack
+
+  # measure the phase of the backup whose yaml config is yml, eg:
+  #   with instrumentation.measure(yml, "spec", "size") as measure:
+  #     ...
+  #   measure["seconds"]
+  @contextmanager
+  def measure(self, yml, phase, name=None):
+    measure = {"backup": yml.get("name"), "kind": yml.get("kind"), "location": yml.get("location"),
+               "phase": phase, "name": name, "bytes_read": 0, "processes": 0}
+    stack = self.stack()
+    stack.append(measure)
+    start = time.time()
+    try:
+      yield measure
+    finally:
+      measure["seconds"] = time.time() - start
+      stack.pop()
+      if stack:
+        stack[-1]["bytes_read"] += measure["bytes_read"]
+        stack[-1]["processes"] += measure["processes"]
+      with self.lock:
+        self.records.append(measure)
+
+  def count_bytes(self, n):
+    stack = self.stack()
+    if stack:
+      stack[-1]["bytes_read"] += n
+
+  # forget measures written
+  def reset(self):
+    with self.lock:
+      self.records = []
+
+  def count_process(self):
+    stack = self.stack()
+    if stack:
+      stack[-1]["processes"] += 1
+
+  # account measures of phases run by other threads on behalf of the
+  # current phase, see prefetch_specs
+  def count_nested(self, measures):
+    stack = self.stack()
+    if stack:
+      for measure in measures:
+        stack[-1]["bytes_read"] += measure["bytes_read"]
+        stack[-1]["processes"] += measure["processes"]
+
+  def write_jsonl(self, path):
+    f = open(path, "a")
+    run = time.strftime("%Y-%m-%dT%H:%M:%S")
+    for record in self.records:
+      f.write(json.dumps(dict(record, run=run))+"\n")
+    f.close()
+
+  # write measures of construction and check of backups, and of tests.
+  # The file is replaced atomically, as expected by node_exporter.
+  def write_prometheus(self, path):
+    textfile = PrometheusTextfile(path)
+    textfile.add(self.records)
+    textfile.close()
+
+# Prometheus textfile, to which measures can be added in multiple times,
+# as by the streaming mode. Samples of each metric must be grouped, so
+# they are kept in a temporary file per metric until the file is written.
+import tempfile
+class PrometheusTextfile:
+  METRICS = [("backup_checker_phase_seconds", "seconds", "Time spent in the phase."),
+             ("backup_checker_phase_bytes_read", "bytes_read", "Bytes read in process by the phase."),
+             ("backup_checker_phase_processes", "processes", "Processes spawned by the phase.")]
+  def __init__(self, path):
+    self.path = path
+    self.samples = dict((metric, tempfile.TemporaryFile()) for metric,key,help in self.METRICS)
+
+  def add(self, records):
+    def labels(record):
+      escape = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+      return ",".join('%s="%s"'%(k, escape(record[k])) for k in ["backup", "kind", "phase", "name"] if record[k] is not None)
+    for metric, key, help in self.METRICS:
+      for record in records:
+        if record["phase"] in ["construct", "check", "test"]:
+          self.samples[metric].write("%s{%s} %s\n"%(metric, labels(record), record[key]))
+
+  def close(self):
+    f = open(self.path+".tmp", "w")
+    for metric, key, help in self.METRICS:
+      f.write("# HELP %s %s\n"%(metric, help))
+      f.write("# TYPE %s gauge\n"%metric)
+      samples = self.samples[metric]
+      samples.seek(0)
+      for line in samples:
+        f.write(line)
+      samples.close()
+    f.close()
+    os.rename(self.path+".tmp", self.path)
+
+instrumentation = Instrumentation()
+
+################################################################################
+# Deadlines bound the time spent on each backup, so that an unreachable
+# host or a hung mount cannot stall the whole run. Timeouts are set in the
+# settings, per backup kind, and in the entry itself, in seconds or as
+# timespans like 10m:
+#   timeouts:
+#     connect: 30        # establishing an ssh or s3 connection
+#     operation: 10m     # one remote command, request or local process
+#     backup: 1h         # building and checking the backup, null for none
+#     retries: 2         # retries of failed connections and channels
+#     per_kind:
+#       ssh_dir:
+#         backup: 2h
+# When an operation times out or the backup runs past its deadline, its
+# processes are killed, its ssh channels closed, and the backup gets the
+# status timeout. If it still does not return, eg blocked reading a hung
+# mount, its thread is abandoned and the other backups go on.
+# Failed connections are retried after a random delay below an
+# exponentially growing bound (full jitter), within the deadline.
+import socket
+import random
+import signal
+import heapq
+
+DEFAULT_TIMEOUTS = {"connect": 30, "operation": 600, "backup": 3600, "retries": 2}
+# time given to a backup past its deadline to return once cancelled
+DEADLINE_GRACE = 5
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 30
+
+class BackupTimeout(Exception):
+  pass
+
+# Thread calling functions at given times, for the deadlines of all
+# backups, so that threads waiting for a backup do not use timed waits,
+# which poll in python 2 and add a millisecond to each wait.
+class Watchdog:
+  def __init__(self):
+    self.condition = threading.Condition()
+    # heap of [time, sequence number, function], function None if cancelled
+    self.timers = []
+    self.sequence = 0
+    self.cancelled = 0
+    self.thread = None
+
+  # call f at time when. Returns a timer, to be given to cancel.
+  def call_at(self, when, f):
+    with self.condition:
+      self.sequence += 1
+      timer = [when, self.sequence, f]
+      heapq.heappush(self.timers, timer)
+      if self.thread is None:
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+      self.condition.notify()
+      return timer
+
+  def cancel(self, timer):
+    with self.condition:
+      if timer[2] is not None:
+        timer[2] = None
+        self.cancelled += 1
+      # the thread is waiting for the timer cancelled when it is the next
+      # one: it then waits for the following one, or stops if there is none
+      if self.timers and self.timers[0] is timer:
+        self.condition.notify()
+      # drop cancelled timers, so that the heap does not grow
+      if self.cancelled > len(self.timers) / 2:
+        self.timers = [t for t in self.timers if t[2] is not None]
+        heapq.heapify(self.timers)
+        self.cancelled = 0
+
+  def run(self):
+    with self.condition:
+      while True:
+        while self.timers and self.timers[0][2] is None:
+          heapq.heappop(self.timers)
+          self.cancelled -= 1
+        if not self.timers:
+          # started again by call_at
+          self.thread = None
+          return
+        elif self.timers[0][0] > time.time():
+          self.condition.wait(self.timers[0][0] - time.time())
+        else:
+          f = heapq.heappop(self.timers)[2]
+          self.condition.release()
+          try:
+            f()
+          except Exception:
+            pass
+          finally:
+            self.condition.acquire()
+
+watchdog = Watchdog()
+
+# returns the timeouts of backup entry yml, settings being the timeouts
+# section of the settings
+def backup_timeouts(settings, yml):
+  settings = settings or {}
+  timeouts = dict(DEFAULT_TIMEOUTS)
+  for source in [settings, settings.get("per_kind", {}).get(yml.get("kind"), {}), yml.get("timeouts") or {}]:
+    timeouts.update((k, v) for k,v in source.items() if k in DEFAULT_TIMEOUTS)
+  for k in ["connect", "operation", "backup"]:
+    if timeouts[k] is not None:
+      timeouts[k] = parse_timespan(timeouts[k])
+  return timeouts
+
+def format_timeout(seconds):
+  return humanfriendly.format_timespan(seconds)
+
+# Deadline of a backup. Its budget is spent only while the backup is built
+# or checked in run, not while it waits for the other backups.
+# Blocking calls made for the backup register a function cancelling them
+# with cancellable, and get their timeouts from timeout.
+class Deadline:
+  def __init__(self, timeouts):
+    self.timeouts = timeouts
+    self.budget = timeouts["backup"]
+    self.used = 0
+    # time at which the deadline passes, while running
+    self.end = None
+    self.expired = False
+    self.cancelled = threading.Event()
+    self.lock = threading.Lock()
+    self.cancels = {}
+
+  # seconds left, None if there is no deadline
+  def remaining(self):
+    if self.budget is None:
+      return None
+    if self.end is None:
+      return max(0, self.budget - self.used)
+    return max(0, self.end - time.time())
+
+  # timeout of one step, connect or operation, bounded by the deadline
+  def timeout(self, step):
+    timeout, remaining = self.timeouts[step], self.remaining()
+    if remaining is None or (timeout is not None and timeout < remaining):
+      return timeout
+    return remaining
+
+  def check(self):
+    if self.expired or self.remaining() == 0:
+      raise BackupTimeout("not done within %s"%format_timeout(self.budget))
+
+  # context manager registering function cancel, called if the deadline
+  # passes while in the block
+  @contextmanager
+  def cancellable(self, cancel):
+    key = object()
+    with self.lock:
+      self.cancels[key] = cancel
+    try:
+      yield
+    finally:
+      with self.lock:
+        self.cancels.pop(key, None)
+
+  def cancel(self):
+    with self.lock:
+      self.expired = True
+      cancels = self.cancels.values()
+      self.cancels = {}
+    self.cancelled.set()
+    for cancel in cancels:
+      try:
+        cancel()
+      except Exception:
+        pass
+
+  # returns f(), run as current deadline of a thread of its own, which is
+  # abandoned if it does not return by the deadline.
+  # Socket timeouts are reported as BackupTimeout.
+  def run(self, f):
+    result = {}
+    def target():
+      previous = getattr(deadlines, "current", None)
+      deadlines.current = self
+      try:
+        result["value"] = f()
+      except socket.timeout, e:
+        result["error"] = (BackupTimeout, BackupTimeout("no answer within %s ( %s )"%(format_timeout(self.timeouts["operation"]), e)), sys.exc_info()[2])
+      except:
+        result["error"] = sys.exc_info()
+      finally:
+        deadlines.current = previous
+    self.check()
+    start = time.time()
+    if self.budget is None:
+      target()
+    else:
+      self.end = start + self.remaining()
+      # released when f returns, or by the watchdog when abandoning it
+      done = threading.Lock()
+      done.acquire()
+      def finish():
+        with self.lock:
+          if "finished" in result:
+            return
+          result["finished"] = True
+        done.release()
+      def run_target():
+        target()
+        finish()
+      thread = threading.Thread(target=run_target)
+      thread.daemon = True
+      thread.start()
+      timers = [watchdog.call_at(self.end, self.cancel), watchdog.call_at(self.end + DEADLINE_GRACE, finish)]
+      done.acquire()
+      for timer in timers:
+        watchdog.cancel(timer)
+      self.end = None
+    self.used += time.time() - start
+    if "value" not in result and "error" not in result:
+      raise BackupTimeout("not done within %s, abandoned"%format_timeout(self.budget))
+    # errors of operations cancelled are reported as a timeout
+    if "error" in result and not self.expired:
+      raise result["error"][0], result["error"][1], result["error"][2]
+    self.check()
+    return result["value"]
+
+  # returns the standard output of process, killed if it does not complete
+  # within the operation timeout or by the deadline. Processes are started
+  # in a process group of their own, see run_command, so that their
+  # children, which may hold their output open, are killed with them.
+  def communicate(self, process, description):
+    killed = []
+    def kill():
+      killed.append(True)
+      try:
+        os.killpg(process.pid, signal.SIGKILL)
+      except OSError:
+        pass
+    timeout = self.timeout("operation")
+    timer = None
+    if timeout is not None:
+      timer = watchdog.call_at(time.time() + timeout, kill)
+    try:
+      with self.cancellable(kill):
+        output = process.communicate()
+    finally:
+      if timer:
+        watchdog.cancel(timer)
+    if killed:
+      self.check()
+      raise BackupTimeout("%s not done within %s"%(description, format_timeout(self.timeouts["operation"])))
+    return output
+
+  # returns f(), retrying it on errors but fatal ones with jittered
+  # exponential backoff, as many times as configured in retries
+  def retry(self, f, errors=(Exception,), fatal=()):
+    for attempt in range(self.timeouts["retries"]+1):
+      try:
+        return f()
+      except errors, e:
+        delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY*2**attempt))
+        remaining = self.remaining()
+        if isinstance(e, fatal) or attempt == self.timeouts["retries"] or (remaining is not None and delay >= remaining):
+          raise
+      self.cancelled.wait(delay)
+      self.check()
+
+# deadline of the backup handled by the current thread, see current_deadline
+deadlines = threading.local()
+# deadline of work done outside of backups, with only operation timeouts
+no_deadline = Deadline(dict(DEFAULT_TIMEOUTS, backup=None))
+
+def current_deadline():
+  return getattr(deadlines, "current", None) or no_deadline
+
+# run command, returning its standard output. It is killed if it runs past
+# the operation timeout or the deadline of the current backup.
+def run_command(args, cwd=None):
+  instrumentation.count_process()
+  process = subprocess.Popen(args, cwd=cwd, stdout=subprocess.PIPE, preexec_fn=os.setsid)
+  return current_deadline().communicate(process, " ".join(args))[0]
+
 ################################################################################
 # The test classes are used to perform one test on 
 # the backup. 
@@ -26,7 +480,20 @@ import hashlib
 # the backup
 # The test are done in the check method, which takes
 # the backup to test as argument.
+# Each test class declares in reads the specs it needs from the backup,
+# so that only those are collected (see BackupSpecs).
+# It declares in cost the class of I/O needed to collect them, so that
+# cheap tests are run first and a failure spares the expensive ones (see
+# plan_tests). Classes, from the cheapest:
+COST_METADATA = 0          # a stat, or values known from earlier I/O
+COST_LISTING = 1           # listing a directory or repository, or reading samples
+COST_FULL_READ = 2         # reading the whole backup
+COST_REMOTE_FULL_READ = 3  # reading the whole backup over the network
+
 class Test:
+  # None means the spec named after the class, as used by run_test below
+  reads = None
+  cost = COST_METADATA
   def __init__(self, backup, params={}):
     self.params = params
     self.backup=backup
@@ -51,7 +518,10 @@ class Test:
   # precisely
     pass
   def check(self):
-    self.run_test()
+    with instrumentation.measure(self.backup.yml, "test", self.__class__.__name__) as measure:
+      self.run_test()
+    # time taken, see TestCosts
+    self.seconds = measure["seconds"]
     if self.result:
       message=self.success_message
     else:
@@ -65,12 +535,29 @@ class Test:
     pass
   def add_spec(self, key, value):
     self.backup.specs.set(key,value)
+  # specs needed by the test
+  def needed_specs(self):
+    if self.reads is None:
+      return [self.__class__.__name__.replace("Test","").lower()]
+    return self.reads
+  # cost class of the test on its backup. Specs already known cost
+  # nothing, and backups can declare that they collect some specs with
+  # more I/O than tests expect, eg the size of a directory.
+  def cost_class(self):
+    pending = [k for k in self.needed_specs() if self.backup.specs.is_pending(k)]
+    if not pending:
+      return COST_METADATA
+    cost = max([self.cost] + [self.backup.spec_costs.get(k, COST_METADATA) for k in pending])
+    if cost == COST_FULL_READ and self.backup.remote:
+      return COST_REMOTE_FULL_READ
+    return cost
 
 # Check size of backup is above the minimum value as
 # specified in the yaml.
 # minsize can be specified in bytes or with the unit suffix
 # eg : 5Kb
 class MinsizeTest(Test):
+  reads = ["size"]
   def prepare(self):
     # parse file sizes with humanfriendly
     if self.params.__class__.__name__=="str":
@@ -87,15 +574,48 @@ class MinsizeTest(Test):
     # perform test
     self.result = self.backup.specs.get("size")>=self.minsize
 
+# Check size of each match of a fileglob backup is above the minimum value
+class MatchMinsizeTest(MinsizeTest):
+  reads = ["min_match_size"]
+  cost = COST_LISTING
+  def run_test(self):
+    # setup messages
+    self.success_message = "Minimum size of matches respected ( smallest "+ str(self.backup.specs.get("min_match_size")) +" !< " + str(self.minsize) +" )."
+    self.error_message = "Minimum size of matches not respected ( smallest "+ str(self.backup.specs.get("min_match_size")) +" < " + str(self.minsize) +" )."
+
+    # perform test
+    self.result = self.backup.specs.get("min_match_size")>=self.minsize
+
+# Different versions of file report different types for the same format
+MIME_ALIASES = {
+  "application/x-gzip": "application/gzip",
+  "application/x-bzip": "application/x-bzip2",
+  "application/x-zstd": "application/zstd",
+}
+def same_mimetype(a, b):
+  return MIME_ALIASES.get(a, a) == MIME_ALIASES.get(b, b)
+
+# For backups of multiple files, like globs, the type of each file is
+# checked, using the spec mimetypes (dict mimetype -> number of files).
 class FiletypeTest(Test):
+  reads = ["mimetype"]
   def run_test(self):
+    if self.backup.specs.has("mimetypes"):
+      mimetypes = self.backup.specs.get("mimetypes")
+    else:
+      mimetypes = {self.backup.specs.get("mimetype"): 1}
+    if len(mimetypes) == 1:
+      found = str(mimetypes.keys()[0])
+    else:
+      found = ", ".join("%s (%d files)"%(t,n) for t,n in sorted(mimetypes.items()))
     # set messages
-    self.success_message = "File type correct ( "+ self.backup.specs.get("mimetype") +" == " + self.params +" )."
-    self.error_message =   "File type INCORRECT ( "+ self.backup.specs.get("mimetype") +" != " + self.params +" )."
+    self.success_message = "File type correct ( "+ found +" == " + self.params +" )."
+    self.error_message =   "File type INCORRECT ( "+ found +" != " + self.params +" )."
     # set result
-    self.result = self.backup.specs.get("mimetype") == self.params
+    self.result = all(same_mimetype(t, self.params) for t in mimetypes)
 
 class MaxAgeTest(Test):
+  reads = ["mtime"]
   def run_test(self):
     # set messages
     elapsed_time_text = str(humanfriendly.Timer(self.backup.specs.get("mtime")).elapsed_time)
@@ -104,54 +624,173 @@ class MaxAgeTest(Test):
     # set result
     self.result = humanfriendly.Timer(self.backup.specs.get("mtime")).elapsed_time <=  self.params
 
+# Check the newest match of a fileglob backup is younger than the value
+class NewestMatchMaxAgeTest(Test):
+  reads = ["newest_match_mtime"]
+  cost = COST_LISTING
+  def run_test(self):
+    # set messages
+    elapsed_time_text = str(humanfriendly.Timer(self.backup.specs.get("newest_match_mtime")).elapsed_time)
+    self.success_message = "Newest match last modification time correct ( "+ elapsed_time_text +" <= " + str(self.params) +" )."
+    self.error_message =   "Newest match last modification time INCORRECT ( "+ elapsed_time_text +" > " + str(self.params) +" )."
+    # set result
+    self.result = humanfriendly.Timer(self.backup.specs.get("newest_match_mtime")).elapsed_time <=  self.params
+
+# Directories are listed with scandir, which gives the type of entries
+# without stat calls. It is in the os module from python 3.5, and in the
+# scandir package for older versions. Without it, entries are stat'ed.
+import stat
+try:
+  from os import scandir
+except ImportError:
+  try:
+    from scandir import scandir
+  except ImportError:
+    scandir = None
+
+# Minimal replacement of os.DirEntry, used when scandir is not available
+class ListdirEntry:
+  def __init__(self, directory, name):
+    self.name = name
+    self.path = os.path.join(directory, name)
+    self.stats = {}
+  def stat(self, follow_symlinks=True):
+    if follow_symlinks not in self.stats:
+      if follow_symlinks:
+        self.stats[follow_symlinks] = os.stat(self.path)
+      else:
+        self.stats[follow_symlinks] = os.lstat(self.path)
+    return self.stats[follow_symlinks]
+  # false for a dangling symlink or an entry removed since listed, as
+  # with os.DirEntry
+  def is_dir(self, follow_symlinks=True):
+    try:
+      return stat.S_ISDIR(self.stat(follow_symlinks).st_mode)
+    except OSError:
+      return False
+  def is_file(self, follow_symlinks=True):
+    try:
+      return stat.S_ISREG(self.stat(follow_symlinks).st_mode)
+    except OSError:
+      return False
+
+# iterate over entries of directory at path
+def scan_dir(path):
+  if scandir:
+    return scandir(path)
+  return (ListdirEntry(path, name) for name in os.listdir(path))
+
+# Parameters:
+#   max_age: maximum age of the newest entry, in seconds
+#   depth: number of levels of subdirectories to look into, default 0
+#   with_hidden, with_dirs, with_files: set to false to ignore these entries
+#   short_circuit: stop looking as soon as an entry younger than max_age
+#     is found, which is then reported instead of the newest. Default false
+#   workers: number of subdirectories scanned in parallel, default 4
 class DirectoryNewestEntryMaxAgeTest(Test):
-  # looks recursively (up to depth levels) for the most recent file
-  def newest_in(self,path, depth=0):
-    if "with_hidden" in self.params.keys() and not self.params["with_hidden"] and "with_dirs" in self.params.keys() and not self.params["with_dirs"] and "with_files" in self.params.keys() and not self.params["with_files"]:
+  reads = ["newest_entry_mtime"]
+  cost = COST_LISTING
+  def prepare(self):
+    if not self.params.get("with_hidden",True) and not self.params.get("with_dirs",True) and not self.params.get("with_files",True):
       raise Exception("Configuration Error, all entries disabled in configuration of %s"%self.backup.name)
+    self.newest_entry = None
+
+  # true if the walk of the directory done for other specs gives the answer,
+  # ie when other tests need it and all entries are considered
+  def uses_walk(self):
+    if "walk" not in self.backup.specs.specs:
+      return False
+    if not any(k in self.backup.needed_specs() for k in DirectoryBackup.walk_specs):
+      return False
+    return all(self.params.get(k,True) for k in ["with_hidden", "with_dirs", "with_files"])
+
+  # true if the manifest of a remote directory gives the answer, see
+  # SshDirBackup
+  def uses_manifest(self):
+    if "manifest" not in self.backup.specs.specs:
+      return False
+    return all(self.params.get(k,True) for k in ["with_hidden", "with_dirs", "with_files"])
+
+  # true if the entry can be the newest one
+  def is_candidate(self, is_dir):
+    if is_dir:
+      return self.params.get("with_dirs",True)
+    return self.params.get("with_files",True)
+
+  # looks recursively (up to depth levels) for the most recent entry.
+  # If newer_than is given, returns the first entry found with a more recent
+  # mtime, and sets the stop event so that other threads stop looking.
+  def newest_in(self, path, depth=0, newer_than=None, stop=None, workers=1):
     newest_path=None
     newest_time=None
-    for e in os.listdir(path):
-      if "with_hidden" in self.params.keys() and not self.params["with_hidden"] and fnmatch.fnmatch(e,".*"):
-        continue
-      if "with_dirs" in self.params.keys() and not self.params["with_dirs"] and os.path.isdir(e):
+    subdirs=[]
+    for e in scan_dir(path):
+      if stop is not None and stop.is_set():
+        break
+      if not self.params.get("with_hidden",True) and e.name.startswith("."):
         continue
-      if "with_files" in self.params.keys() and not self.params["with_files"] and os.path.isfile(e):
+      try:
+        is_dir = e.is_dir()
+        entry_time = e.stat().st_mtime
+        # symlinks to directories are entries, but are not descended into,
+        # as in the directory walk, so that a link cycle is not followed
+        is_subdir = is_dir and depth>0 and e.is_dir(follow_symlinks=False)
+      except OSError:
         continue
+      if self.is_candidate(is_dir) and (newest_time==None or entry_time>newest_time):
+        newest_time=entry_time
+        newest_path=e.path
+        if newer_than is not None and entry_time>newer_than:
+          if stop is not None:
+            stop.set()
+          return (newest_path, newest_time)
+      if is_subdir:
+        subdirs.append(e.path)
+
+    def newest_in_subdir(subdir):
       try:
-        entry_path="%s/%s"%(path.rstrip("/"),e)
-        entry_time=os.path.getmtime(entry_path)
-        if newest_time==None or entry_time>newest_time:
-          newest_time=entry_time
-          newest_path=entry_path
-        if os.path.isdir(e) and depth>0:
-          in_dir_path, in_dir_time = self.newest_in(e)
-          if in_dir_time>newest_time:
-            newest_time=in_dir_time
-            newest_path=in_dir_path
-      except:
-        pass
+        return self.newest_in(subdir, depth-1, newer_than, stop)
+      except OSError:
+        return (None, None)
+    for in_dir_path, in_dir_time in ConcurrencyLimits({"workers": workers}).map(newest_in_subdir, subdirs, lambda d: {}):
+      if in_dir_time is not None and (newest_time==None or in_dir_time>newest_time):
+        newest_time=in_dir_time
+        newest_path=in_dir_path
     return (newest_path, newest_time)
 
   def add_specs(self):
     # define function that will collect the latest entry's mtime
     def f():
-      if "depth" in self.params.keys():
-        depth = self.params["depth"]
-      else:
-        depth=0
-      self.newest_entry, newest_time = self.newest_in(self.backup.get("location"), depth)
-      return os.path.getmtime(self.newest_entry)
+      newer_than = None
+      stop = None
+      if self.params.get("short_circuit", False):
+        newer_than = time.time()-self.params["max_age"]
+        stop = threading.Event()
+      elif self.uses_walk():
+        self.newest_entry, newest_time = self.backup.specs.get("walk").newest(self.params.get("depth",0))
+        return newest_time
+      elif self.uses_manifest():
+        # the manifest does not give paths of entries
+        self.newest_entry = "%s, depth <= %d"%(self.backup.get("location"), self.params.get("depth",0))
+        return self.backup.specs.get("manifest").newest_at(self.params.get("depth",0))
+      self.newest_entry, newest_time = self.newest_in(self.backup.get("location"), self.params.get("depth",0), newer_than, stop, self.params.get("workers",4))
+      return newest_time
     self.add_spec("newest_entry_mtime", f)
 
   def run_test(self):
-    elapsed_time_text = str(humanfriendly.Timer(self.backup.specs.get("newest_entry_mtime")).elapsed_time)
+    newest_time = self.backup.specs.get("newest_entry_mtime")
+    if newest_time is None:
+      self.error_message = "No entry found in "+self.backup.get("location")+"."
+      self.result = False
+      return
+    elapsed_time_text = str(humanfriendly.Timer(newest_time).elapsed_time)
     self.success_message = "Newest entry ("+self.newest_entry+") last modification time correct ( "+ elapsed_time_text +" <= " + str(self.params["max_age"]) +" )."
     self.error_message =   "Newest entry ("+self.newest_entry+") last modification time INCORRECT ( "+ elapsed_time_text +" > " + str(self.params["max_age"]) +" )."
     # set result
-    self.result = humanfriendly.Timer(self.backup.specs.get("newest_entry_mtime")).elapsed_time <=  self.params
+    self.result = humanfriendly.Timer(newest_time).elapsed_time <=  self.params["max_age"]
 
 class MinAgeTest(Test):
+  reads = ["mtime"]
   def run_test(self):
     # set messages
     elapsed_time_text = str(humanfriendly.Timer(self.backup.specs.get("mtime")).elapsed_time)
@@ -161,13 +800,151 @@ class MinAgeTest(Test):
     self.result = humanfriendly.Timer(self.backup.specs.get("mtime")).elapsed_time >=  self.params
 
 
-class Sha1Test(Test):
+# Compare the digest of the backup with the value in the yaml.
+# The algorithm is taken from the class name, so that the backup
+# can compute all digests needed in one read of the file.
+class DigestTest(Test):
+  cost = COST_FULL_READ
+  def prepare(self):
+    self.algorithm = self.__class__.__name__.replace("Test","").lower()
+    self.reads = [self.algorithm]
+
+class Sha1Test(DigestTest):
+  pass
+
+class Md5Test(DigestTest):
+  pass
+
+class Sha256Test(DigestTest):
   pass
 
-class Md5Test(Test):
+class Blake2Test(DigestTest):
   pass
 
+# Fast verification of very large files, by a fingerprint of sampled
+# blocks (see sample_fingerprint), compared with the one recorded at
+# backup time (check.py --fingerprint FILE prints it), or else with the
+# one of the previous run if the file did not change (this needs the
+# cache). The full digest is only computed on the days of full_days_of_week,
+# or when the sampled check fails, and is then read from the file even if
+# it is in the cache:
+#   sample_digest:
+#     fingerprint: s1:64:1048576:0:2fd4e1c6...
+#     sha1: 2fd4e1c67a2d28fced849ee1bb76e7391b93eb12
+#     full_days_of_week: [7]
+#     blocks: 64
+#     block_size: 1Mb
+#     seed: 0
+# All parameters are optional. Without expected digest, a failed sampled
+# check is not rechecked.
+class SampleDigestTest(Test):
+  reads = ["sample_digest", "identity"]
+  cost = COST_LISTING
+  def prepare(self):
+    if not isinstance(self.params, dict):
+      self.params = {}
+    block_size = self.params.get("block_size", SAMPLE_BLOCK_SIZE)
+    if isinstance(block_size, basestring):
+      block_size = humanfriendly.parse_size(block_size)
+    self.sampling = (self.params.get("blocks", SAMPLE_BLOCKS), block_size, self.params.get("seed", 0))
+    self.algorithm = ([a for a in LOCAL_DIGEST_ALGORITHMS if a in self.params] or [None])[0]
+
+  def full_check_due(self):
+    return date.today().isoweekday() in self.params.get("full_days_of_week", [])
+
+  def run_test(self):
+    fingerprint = self.backup.specs.get("sample_digest")
+    identity = self.backup.specs.get("identity")
+    expected = self.params.get("fingerprint")
+    if expected is None and spec_cache:
+      expected = spec_cache.get_fingerprint(identity)
+    sample_ok = expected is None or expected == fingerprint
+    if spec_cache and sample_ok:
+      spec_cache.set_fingerprint(identity, fingerprint)
+    if self.algorithm and (not sample_ok or self.full_check_due()):
+      digest = file_digests(self.backup.get("location"), [self.algorithm])[self.algorithm]
+      sampled = "sampled check %s, "%("passed" if sample_ok else "FAILED")
+      self.success_message = "File "+self.algorithm+" correct ( "+sampled+"full digest "+digest+" )."
+      self.error_message =   "File "+self.algorithm+" INCORRECT ( "+sampled+"full digest "+digest+" != "+str(self.params[self.algorithm])+" )."
+      self.result = digest == str(self.params[self.algorithm])
+      return
+    self.success_message = "File sampled fingerprint correct ( "+fingerprint+" )."
+    self.error_message =   "File sampled fingerprint INCORRECT ( "+fingerprint+" != "+str(expected)+" )."
+    self.result = sample_ok
+
+# Objects uploaded in multiple parts have an etag ending with -N, N being
+# the number of parts. Checking N against the part size used by the upload
+# detects incomplete or botched uploads without downloading anything:
+#   multipart_etag:
+#     part_size: 8MiB
+# Objects not bigger than part_size are expected to be uploaded in one part
+# (aws s3 cp uses the same size as threshold and part size). The expected
+# etag, recorded at upload time, can be given instead:
+#   multipart_etag:
+#     etag: d41d8cd98f00b204e9800998ecf8427e-38
+class MultipartEtagTest(Test):
+  reads = ["etag", "size"]
+  def expected_parts(self):
+    part_size = self.params.get("part_size", S3_PART_SIZE)
+    if isinstance(part_size, basestring):
+      part_size = humanfriendly.parse_size(part_size)
+    size = self.backup.specs.get("size")
+    if size <= part_size:
+      return 1
+    return (size + part_size - 1) // part_size
+
+  def run_test(self):
+    etag = self.backup.specs.get("etag")
+    if "etag" in self.params:
+      expected = str(self.params["etag"])
+      self.result = etag == expected
+    else:
+      parts = int(etag.split("-")[1]) if "-" in etag else 1
+      expected = "%d parts"%self.expected_parts()
+      self.result = parts == self.expected_parts()
+    # set messages
+    self.success_message = "Multipart etag correct ( "+ etag +" == " + expected +" )."
+    self.error_message =   "Multipart etag INCORRECT ( "+ etag +" != " + expected +" )."
+
+# Git repositories, see verify_pack
+#   git_packs: true
+class GitPacksTest(Test):
+  reads = ["pack_errors"]
+  cost = COST_FULL_READ
+  def run_test(self):
+    errors = self.backup.specs.get("pack_errors")
+    # set messages
+    self.success_message = "Git packs correct."
+    self.error_message =   "Git packs INCORRECT ( "+ ", ".join(errors) +" )."
+    # set result
+    self.result = not errors or not self.params
+
+#   git_refs: true
+class GitRefsTest(Test):
+  reads = ["unresolved_refs"]
+  cost = COST_LISTING
+  def run_test(self):
+    unresolved = self.backup.specs.get("unresolved_refs")
+    # set messages
+    self.success_message = "Git refs resolve."
+    self.error_message =   "Git refs do NOT resolve ( "+ ", ".join(unresolved) +" )."
+    # set result
+    self.result = not unresolved or not self.params
+
+#   min_objects: 10000
+class MinObjectsTest(Test):
+  reads = ["object_count"]
+  cost = COST_LISTING
+  def run_test(self):
+    # set messages
+    self.success_message = "Number of objects correct ( "+ str(self.backup.specs.get("object_count")) +" >= " + str(self.params) +" )."
+    self.error_message =   "Number of objects INCORRECT ( "+ str(self.backup.specs.get("object_count")) +" < " + str(self.params) +" )."
+    # set result
+    self.result = self.backup.specs.get("object_count") >= self.params
+
 class CountTest(Test):
+  reads = ["count"]
+  cost = COST_LISTING
   def run_test(self):
     # set messages
     self.success_message = "Number of matches correct ( "+ str(self.backup.specs.get("count")) +" == " + str(self.params) +" )."
@@ -176,6 +953,8 @@ class CountTest(Test):
     self.result = self.backup.specs.get("count") == self.params
 
 class MinEntriesCountTest(Test):
+  reads = ["entries_count"]
+  cost = COST_LISTING
   def run_test(self):
     # set messages
     self.success_message = "Number of file correct ( "+ str(self.backup.specs.get("entries_count")) +" >= " + str(self.params) +" )."
@@ -183,19 +962,304 @@ class MinEntriesCountTest(Test):
     # set result
     self.result = self.backup.specs.get("entries_count") >= self.params
 
+# Archive tests, for file and fileglob backups. The archive is verified in
+# the read computing digests, see ArchiveReader. For fileglob backups,
+# each match is tested.
+#   archive_integrity: true
+class ArchiveIntegrityTest(Test):
+  reads = ["archive_error"]
+  cost = COST_FULL_READ
+  def run_test(self):
+    error = self.backup.specs.get("archive_error")
+    # set messages
+    self.success_message = "Archive integrity correct."
+    self.error_message =   "Archive integrity INCORRECT ( "+ str(error) +" )."
+    # set result
+    self.result = error is None or not self.params
+
+# minimum number of members of tar archives
+#   min_members: 100
+class MinMembersTest(Test):
+  reads = ["archive_members"]
+  cost = COST_FULL_READ
+  def run_test(self):
+    members = self.backup.specs.get("archive_members")
+    # set messages
+    self.success_message = "Number of archive members correct ( "+ str(members) +" >= " + str(self.params) +" )."
+    if members is None:
+      self.error_message = "Number of archive members INCORRECT ( not a tar archive )."
+    else:
+      self.error_message = "Number of archive members INCORRECT ( "+ str(members) +" < " + str(self.params) +" )."
+    # set result
+    self.result = members is not None and members >= self.params
+
+# names of members expected in tar archives, possibly with wildcards
+#   archive_contains: [etc/passwd, "var/lib/mysql/*"]
+class ArchiveContainsTest(Test):
+  reads = ["archive_found"]
+  cost = COST_FULL_READ
+  def prepare(self):
+    self.patterns = self.params
+    if isinstance(self.patterns, basestring):
+      self.patterns = [self.patterns]
+  def run_test(self):
+    found = self.backup.specs.get("archive_found")
+    missing = [p for p in self.patterns if p not in found]
+    # set messages
+    self.success_message = "Archive members present ( "+ ", ".join(self.patterns) +" )."
+    self.error_message =   "Archive members MISSING ( "+ ", ".join(missing) +" )."
+    # set result
+    self.result = not missing
+
+
+################################################################################
+# Persistent cache of expensive specs, like digests of big archives which
+# do not change from one run to the next.
+# Values are keyed by the identity of the file (device, inode, size and
+# mtime in ns), so a file modified or replaced is not found in the cache.
+# It is an sqlite database, enabled in the settings:
+#   cache:
+#     path: /var/cache/backup_checker.sqlite
+#     max_entries: 100000
+# path defaults to .backup_checker.sqlite next to the config file.
+# The least recently used entries are evicted when max_entries is reached.
+# sqlite locking makes it safe to use from multiple threads and processes.
+# The lists of entries of directories can be stored in the same database,
+# see DirectoryWalk. They are not keyed by identity, so this is enabled
+# separately in the settings:
+#   directory_cache: true
+import sqlite3
+import marshal
+
+# mtime in ns of stat result st
+def mtime_ns(st):
+  mtime_ns = getattr(st, "st_mtime_ns", None)
+  if mtime_ns is None:
+    mtime_ns = int(round(st.st_mtime*1e9))
+  return mtime_ns
+
+class SpecCache:
+  def __init__(self, path, max_entries=100000):
+    self.path = path
+    self.max_entries = max_entries
+    self.local = threading.local()
+    self.lock = threading.Lock()
+    self.connections = []
+    self.hits = 0
+    self.misses = 0
+    # identity -> size of files whose digests were found in the cache,
+    # and identities of files read anyway, eg for archive tests, to count
+    # the bytes not read thanks to the cache
+    self.hit_files = {}
+    self.read_files = set()
+    db = self.db()
+    db.execute("create table if not exists digests (dev integer, ino integer, size integer, mtime_ns integer, algorithm text, digest text, used real, primary key (dev, ino, size, mtime_ns, algorithm))")
+    db.execute("create index if not exists digests_used on digests (used)")
+    db.execute("create table if not exists directories (path blob primary key, mtime_ns integer, data blob, used real)")
+    db.execute("create index if not exists directories_used on directories (used)")
+    db.execute("create table if not exists fingerprints (dev integer, ino integer, size integer, mtime_ns integer, fingerprint text, used real, primary key (dev, ino, size, mtime_ns))")
+    db.execute("create table if not exists test_costs (backup text, test text, seconds real, used real, primary key (backup, test))")
+    db.commit()
+
+  # sqlite connections cannot be used by multiple threads at the same
+  # time, so each thread gets its own.
+  def db(self):
+    if not hasattr(self.local, "db"):
+      self.local.db = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+      with self.lock:
+        self.connections.append(self.local.db)
+    return self.local.db
+
+  def get_digest(self, identity, algorithm):
+    db = self.db()
+    row = db.execute("select digest from digests where dev=? and ino=? and size=? and mtime_ns=? and algorithm=?", identity+(algorithm,)).fetchone()
+    with self.lock:
+      if row is None:
+        self.misses += 1
+        return None
+      self.hits += 1
+      self.hit_files[identity] = identity[2]
+    db.execute("update digests set used=? where dev=? and ino=? and size=? and mtime_ns=? and algorithm=?", (time.time(),)+identity+(algorithm,))
+    db.commit()
+    return str(row[0])
+
+  def set_digest(self, identity, algorithm, digest):
+    db = self.db()
+    db.execute("insert or replace into digests values (?,?,?,?,?,?,?)", identity+(algorithm, digest, time.time()))
+    # evict least recently used entries
+    db.execute("delete from digests where rowid in (select rowid from digests order by used desc limit -1 offset ?)", (self.max_entries,))
+    db.commit()
+
+  # returns the sampled fingerprint of the file of identity at the previous
+  # run, see SampleDigestTest
+  def get_fingerprint(self, identity):
+    row = self.db().execute("select fingerprint from fingerprints where dev=? and ino=? and size=? and mtime_ns=?", identity).fetchone()
+    if row is None:
+      return None
+    return str(row[0])
+
+  def set_fingerprint(self, identity, fingerprint):
+    db = self.db()
+    db.execute("insert or replace into fingerprints values (?,?,?,?,?,?)", identity+(fingerprint, time.time()))
+    db.execute("delete from fingerprints where rowid in (select rowid from fingerprints order by used desc limit -1 offset ?)", (self.max_entries,))
+    db.commit()
+
+  # returns the time taken by test of backup at previous runs, see TestCosts
+  def get_test_cost(self, backup, test):
+    row = self.db().execute("select seconds from test_costs where backup=? and test=?", (backup, test)).fetchone()
+    if row is None:
+      return None
+    return row[0]
+
+  # store times taken by tests, costs being a dict (backup, test) -> seconds
+  def set_test_costs(self, costs):
+    db = self.db()
+    now = time.time()
+    db.executemany("insert or replace into test_costs values (?,?,?,?)", [(backup, test, seconds, now) for (backup, test),seconds in costs.items()])
+    db.execute("delete from test_costs where rowid in (select rowid from test_costs order by used desc limit -1 offset ?)", (self.max_entries,))
+    db.commit()
+
+  # returns the data of the directory at path if it was stored with the
+  # same mtime, see DirectoryWalk
+  def get_directory(self, path, mtime_ns):
+    stored = self.stored_directory(path)
+    if stored is None or stored[0] != mtime_ns:
+      return None
+    return stored[1]
+
+  # returns (mtime_ns, data) stored for the directory at path, or None
+  def stored_directory(self, path):
+    row = self.db().execute("select mtime_ns, data from directories where path=?", (sqlite3.Binary(path),)).fetchone()
+    if row is None:
+      return None
+    return (row[0], marshal.loads(bytes(row[1])))
+
+  # store data of a directory. Changes are only saved by commit, so that
+  # a walk storing many directories is done in one transaction.
+  def set_directory(self, path, mtime_ns, data):
+    self.db().execute("insert or replace into directories values (?,?,?,?)", (sqlite3.Binary(path), mtime_ns, sqlite3.Binary(marshal.dumps(data)), time.time()))
+
+  def commit(self):
+    db = self.db()
+    db.execute("delete from directories where rowid in (select rowid from directories order by used desc limit -1 offset ?)", (self.max_entries,))
+    db.commit()
+
+  # record that the file of identity was read
+  def count_read(self, identity):
+    with self.lock:
+      self.read_files.add(identity)
+
+  def bytes_saved(self):
+    with self.lock:
+      return sum(size for identity,size in self.hit_files.items() if identity not in self.read_files)
+
+  def summary(self):
+    return "Cache: %d hits, %d misses, %s not read\n"%(self.hits, self.misses, humanfriendly.format_size(self.bytes_saved()))
+
+  def close(self):
+    with self.lock:
+      for db in self.connections:
+        db.close()
+      self.connections = []
+    self.local = threading.local()
 
+# set by BackupChecker when enabled in the settings
+spec_cache = None
+directory_cache = None
+
+# The error of a spec which could not be computed, as given by sys.exc_info
+class SpecError:
+  def __init__(self, error):
+    self.error = error
+
+# Specs are the values describing a backup, which tests check.
+# Backups register providers computing them in collect_specs, and a
+# provider is only called when a test needs one of its specs: specs not
+# read by any configured test are never collected.
+# A provider can compute multiple specs with one operation, eg size and
+# mtime with one stat, and can require other specs, which are computed
+# before it is called.
 class BackupSpecs:
-  def __init__(self):
+  def __init__(self, yml={}):
+    # yaml config of the backup, for instrumentation
+    self.yml=yml
     self.specs={}
+    # specs that can be stored in the cache, keyed by the spec identity
+    self.cacheable=set()
+  # set the value of k, or a function computing it
   def set(self,k,v):
     self.specs[k]=v
+  # register f as provider of keys.
+  # f(k) returns a dict holding the value of k, and possibly of other keys
+  # computed at the same time, which are memoized too.
+  # The specs in requires are computed before calling f.
+  # Keys of a provider asked by multiple threads, see prefetch_specs, are
+  # computed once. If f fails, all its keys fail with the same error.
+  def provide(self,keys,f,requires=()):
+    lock = threading.Lock()
+    def provider(k):
+      def compute():
+        with lock:
+          if not self.is_pending(k):
+            return self.get(k)
+          try:
+            for r in requires:
+              self.get(r)
+            values = f(k)
+          except Exception:
+            error = SpecError(sys.exc_info())
+            for key in keys:
+              if self.is_pending(key):
+                self.specs[key]=error
+            raise
+          for key,value in values.items():
+            if key in keys and self.is_pending(key):
+              self.specs[key]=value
+          return self.specs[k]
+      return compute
+    for k in keys:
+      self.specs[k]=provider(k)
+  # compute and memoize the value of k. A spec whose computation failed
+  # raises the same error each time it is read, without computing it again.
   def get(self,k):
     item = self.specs[k]
-    # compute and memoize
     if callable(item):
-      result = item()
-      self.specs[k] = result
-    return self.specs[k]
+      with instrumentation.measure(self.yml, "spec", k):
+        result = self.cached(k)
+        if result is None:
+          try:
+            result = item()
+          except Exception:
+            if self.is_pending(k):
+              self.specs[k] = SpecError(sys.exc_info())
+            raise
+        self.specs[k] = result
+        self.store_cached()
+    item = self.specs[k]
+    if isinstance(item, SpecError):
+      raise item.error[0], item.error[1], item.error[2]
+    return item
+  def has(self,k):
+    return k in self.specs
+  # true if the value of k is still to be computed
+  def is_pending(self,k):
+    return callable(self.specs.get(k))
+  # mark keys as cacheable. Their values are digests of the file whose
+  # identity is given by the spec identity, see SpecCache
+  def set_cacheable(self,keys):
+    self.cacheable.update(keys)
+  def cached(self,k):
+    if spec_cache is None or k not in self.cacheable:
+      return None
+    return spec_cache.get_digest(self.get("identity"), k)
+  # store cacheable values computed, possibly by the same operation
+  def store_cached(self):
+    if spec_cache is None:
+      return
+    for k in list(self.cacheable):
+      if not self.is_pending(k) and not isinstance(self.specs[k], SpecError):
+        spec_cache.set_digest(self.get("identity"), k, self.specs[k])
+        self.cacheable.discard(k)
 
 
 
@@ -204,7 +1268,30 @@ class BackupSpecs:
 # and other data like name and description.
 # It initialises the validators defined for it in the yaml file
 from datetime import date
+
+# Backup and test classes are named after their kind and key in the yaml,
+# eg kind s3_fileglob is handled by S3FileglobBackup and test max_age by
+# MaxAgeTest. The modules needed by a backend are imported when it is
+# first used, see LazyModule.
+def backup_class(kind):
+  klass = globals().get(kind.title().replace("_","")+"Backup")
+  if klass is None:
+    raise Exception("Configuration Error, unknown backup kind %s"%kind)
+  return klass
+
+def test_class(key):
+  klass = globals().get(key.title().replace("_","")+"Test")
+  if klass is None:
+    raise Exception("Configuration Error, unknown test %s"%key)
+  return klass
+
 class Backup:
+  status = None
+  # true for backups read over the network
+  remote = False
+  # cost classes of specs collected with more I/O than tests expect, see
+  # Test.cost_class
+  spec_costs = {}
   def __init__(self, yml):
     # path is value configure in yaml file
     # location is value as discovered by backup checker. At start, same value
@@ -213,7 +1300,9 @@ class Backup:
     self.name     = yml["name"]
     self.kind     = yml["kind"]
     self.yml      = yml
-    self.specs    = BackupSpecs()
+    self.specs    = BackupSpecs(yml)
+    # time spent building and checking the backup, set by BackupChecker
+    self.elapsed  = 0
     if yml["tests"]: # and  yml["validators"]
       self.tests = [self.initialize_test(k,v) for k,v in yml["tests"].iteritems()]
     else:
@@ -222,39 +1311,72 @@ class Backup:
     # collect specs only if backup exists
     if not self.to_be_run_today():
       self.set_skipped()
-    elif self.exists():
+    elif self.measured_exists():
       self.status = 'unchecked'
       self.collect_specs()
+      self.check_specs()
     else:
       self.set_invalid()
   def exists(self):
     return os.path.isfile(self.location)
+  def measured_exists(self):
+    with instrumentation.measure(self.yml, "exists"):
+      return self.exists()
+  # register providers of specs, see BackupSpecs
   def collect_specs(self):
     pass
+  # invalidate the backup if a test needs a spec not available for its kind
+  def check_specs(self):
+    for t in self.tests:
+      for k in t.needed_specs():
+        if not self.specs.has(k):
+          self.log_message(False, "Test "+t.__class__.__name__+" not supported for "+self.kind+" backups ( no "+k+" ).")
+          self.set_invalid()
+  # specs needed by the configured tests
+  def needed_specs(self):
+    return set(k for t in self.tests for k in t.needed_specs())
   # locate, instanciate test class, and call its add_specs method
   def initialize_test(self,k,v):
-    name = k.title().replace("_","")+"Test"
-    klass = globals()[name]
+    klass = test_class(k)
     test = klass(self,v)
     test.add_specs()
     return test
+  # once timed out, the status is not changed by the abandoned thread
+  # which may still be working on the backup
   def set_valid(self):
-    self.status='valid'
+    if not self.is_timeout():
+      self.status='valid'
   def set_invalid(self):
-    self.status='invalid'
+    if not self.is_timeout():
+      self.status='invalid'
   def set_skipped(self):
     self.status='skipped'
+  def set_timeout(self, message):
+    self.log_message(False, "Timeout, "+message+".")
+    self.status='timeout'
   def done(self):
     self.status!="unchecked"
   def is_invalid(self):
     return self.status=='invalid'
   def is_skipped(self):
     return self.status=='skipped'
+  def is_timeout(self):
+    return self.status=='timeout'
   def log_message(self,success, message):
-    self.messages.append( (success, message) )
+    if not self.is_timeout():
+      self.messages.append( (success, message) )
   # get value for key in yaml config
   def get(self,key):
     return self.yml[key]
+  # digest algorithms needed by the configured tests
+  def digest_algorithms(self):
+    return [t.algorithm for t in self.tests if isinstance(t, DigestTest)]
+  # member names looked for in archives by the tests
+  def archive_patterns(self):
+    return [p for t in self.tests if isinstance(t, ArchiveContainsTest) for p in t.patterns]
+  # true if archive specs are still to be computed for the tests
+  def needs_archive(self, k=None):
+    return any(self.specs.is_pending(a) for a in ARCHIVE_SPECS if a == k or a in self.needed_specs())
   # returns true of it has to be run today
   def to_be_run_today(self):
     if "days_of_week" in self.yml:
@@ -266,76 +1388,850 @@ class Backup:
   def cleanup(self):
     pass
 
+  # checks mostly take well under a minute, shown with sub-second precision
+  def elapsed_text(self):
+    if self.elapsed < 60:
+      return "%.2fs"%self.elapsed
+    return humanfriendly.format_timespan(self.elapsed)
+
   def __str__(self):
     s= "Backup " + self.name + "( " + self.location + ") : " + self.status +"\n"
     for success,m in self.messages:
       s+=m+"\n"
     return s
 
-class FileBackup(Backup):
-  def collect_specs(self):
-    self.specs.set("size",os.path.getsize(self.location))
-   
+# backup of an entry whose construction did not complete by its deadline
+class TimedOutBackup(Backup):
+  def __init__(self, yml, message):
+    self.location = yml["location"]
+    self.path     = self.location
+    self.name     = yml["name"]
+    self.kind     = yml["kind"]
+    self.yml      = yml
+    self.specs    = BackupSpecs(yml)
+    self.elapsed  = 0
+    self.tests    = []
+    self.messages = []
+    self.set_timeout(message)
+
+# Local files are read once to compute all the digests needed, with
+# large buffers. hashlib releases the GIL while hashing such buffers, so
+# files of different backups are hashed in parallel when multiple workers
+# are configured.
+DIGEST_ALGORITHMS = ["md5", "sha1", "sha256", "blake2"]
+DIGEST_BUFFER_SIZE = 4*1024*1024
+
+# blake2 is blake2b, only in hashlib of python >= 3.6, else given by the
+# pyblake2 module if installed. Without it, blake2 is not provided for
+# backups hashed in process, and blake2 tests are reported as not
+# supported (see Backup.check_specs).
+try:
+  import pyblake2
+except ImportError:
+  pyblake2 = None
+# algorithms which can be computed in process
+LOCAL_DIGEST_ALGORITHMS = [a for a in DIGEST_ALGORITHMS if a != "blake2" or hasattr(hashlib, "blake2b") or pyblake2]
+
+def new_hash(algorithm):
+  if algorithm == "blake2":
+    if hasattr(hashlib, "blake2b"):
+      return hashlib.blake2b()
+    return pyblake2.blake2b()
+  return hashlib.new(algorithm)
+
+# returns a dict algorithm -> hex digest of the file at path.
+# If archive is an ArchiveReader, it is fed the data in the same read, and
+# the archive specs it computes are included in the result.
+def file_digests(path, algorithms, archive=None):
+  hashes = dict((a, new_hash(a)) for a in algorithms)
+  buf = bytearray(DIGEST_BUFFER_SIZE)
+  view = memoryview(buf)
+  f = io.open(path, 'rb', buffering=0)
+  try:
+    while True:
+      n = f.readinto(buf)
+      if not n:
+        break
+      for h in hashes.values():
+        h.update(view[:n])
+      if archive:
+        archive.update(buffer(buf, 0, n))
+      instrumentation.count_bytes(n)
+  finally:
+    f.close()
+  result = dict((a, h.hexdigest()) for a,h in hashes.items())
+  if archive:
+    result.update(archive.specs())
+  return result
+
+# The fingerprint of a file samples blocks of block_size bytes: the first,
+# the last, and blocks at offsets drawn from a random generator seeded
+# with seed, so that the same blocks are read at each run. It is the sha1
+# of the size and of these blocks, prefixed by the sampling parameters, eg
+# s1:64:1048576:0:2fd4e1c6... Files smaller than the blocks are read whole.
+SAMPLE_BLOCKS = 64
+SAMPLE_BLOCK_SIZE = 1024*1024
+
+def sample_offsets(size, blocks, block_size, seed):
+  if size <= (blocks+2)*block_size:
+    return range(0, size, block_size)
+  generator = random.Random(seed)
+  offsets = set([0, size-block_size])
+  offsets.update(generator.randrange(0, size-block_size) for i in range(blocks))
+  return sorted(offsets)
+
+def sample_fingerprint(path, blocks=SAMPLE_BLOCKS, block_size=SAMPLE_BLOCK_SIZE, seed=0):
+  h = hashlib.sha1()
+  f = io.open(path, 'rb', buffering=0)
+  try:
+    size = os.fstat(f.fileno()).st_size
+    h.update(str(size))
+    for offset in sample_offsets(size, blocks, block_size, seed):
+      f.seek(offset)
+      data = f.read(block_size)
+      h.update(data)
+      instrumentation.count_bytes(len(data))
+  finally:
+    f.close()
+  return "s1:%d:%d:%s:%s"%(blocks, block_size, seed, h.hexdigest())
+
+################################################################################
+# Archives are verified while they are read for their digests: gzip, bzip2
+# and xz streams are decompressed, which checks their CRC and length, and
+# the tar headers of the decompressed data are parsed, giving the number
+# of members and their names. The specs computed are:
+#   archive_error: None, or what is wrong with the archive
+#   archive_members: number of tar members, None if not a tar archive
+#   archive_found: patterns of archive_contains tests matched by a member
+# xz needs the lzma module (python 3, or backports.lzma). Without it, xz
+# archives are tested by xz --test, which reads them again.
+# Decompressors return their output in chunks, so that highly compressed
+# data, eg zeros, is not decompressed in memory at once: gzip output is
+# bounded to DECOMPRESSED_CHUNK bytes. bzip2 and xz decompressors cannot
+# bound their output, so they are given slices of data, sized from the
+# output of the previous ones (see next_slice_size).
+import zlib
+import bz2
+import struct
+try:
+  import lzma
+except ImportError:
+  try:
+    from backports import lzma
+  except ImportError:
+    lzma = None
+
+ARCHIVE_SPECS = ["archive_error", "archive_members", "archive_found"]
+DECOMPRESSED_CHUNK = 1 << 20
+COMPRESSED_SLICE = 64 << 10
+
+# size of the slice of compressed data given next to a decompressor, from
+# the size of the last one and the size of its output: slices grow up to
+# COMPRESSED_SLICE while the output is small, and shrink for the output to
+# stay around DECOMPRESSED_CHUNK. A bzip2 block is decompressed at once,
+# which bounds the output by the size of a block (45MB at most).
+def next_slice_size(size, output_size):
+  if output_size <= DECOMPRESSED_CHUNK:
+    return min(size*2, COMPRESSED_SLICE)
+  return max(1, size*DECOMPRESSED_CHUNK//output_size)
+
+class ArchiveError(Exception):
+  pass
+
+# gzip members, verified by their trailer (crc32 and length of data)
+class GzipStream:
+  def __init__(self):
+    # header, inflate or trailer of the current member
+    self.state = "header"
+    # data of the header or trailer, not processed yet
+    self.pending = ""
+
+  # iterates over the chunks of data decompressed
+  def update(self, data):
+    if self.state == "inflate":
+      for out in self.inflate(data):
+        yield out
+    else:
+      self.pending += str(data)
+    while self.state != "inflate" and self.pending:
+      if self.state == "header":
+        if not self.start_member():
+          break
+        for out in self.inflate(""):
+          yield out
+      elif len(self.pending) >= 8:
+        self.check_trailer()
+      else:
+        break
+
+  # parse the header of a member at the start of pending, returns false
+  # if more data is needed
+  def start_member(self):
+    header = self.pending
+    if not header.strip("\0"):
+      # zeros after the last member are ignored, as by gzip
+      self.pending = ""
+      return False
+    if len(header) < 10:
+      return False
+    if header[:3] != "\x1f\x8b\x08":
+      raise ArchiveError("trailing garbage after gzip stream")
+    flags = ord(header[3])
+    i = 10
     try:
-      output=subprocess.check_output("file --mime-type "+self.location, shell=True)
-    except:
-      # for python 2.6
-      output=subprocess.Popen(["file", "--mime-type", self.location], stdout=subprocess.PIPE).communicate()[0]
+      if flags & 4:
+        i += 2 + struct.unpack("<H", header[i:i+2])[0]
+      # file name and comment are zero terminated
+      for flag in [8, 16]:
+        if flags & flag:
+          i = header.index("\0", i) + 1
+      if flags & 2:
+        i += 2
+    except (ValueError, struct.error):
+      return False
+    if len(header) < i:
+      return False
+    self.inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+    self.crc = 0
+    self.size = 0
+    self.pending = header[i:]
+    self.state = "inflate"
+    return True
+
+  def inflate(self, data):
+    if self.pending:
+      data = self.pending + str(data)
+      self.pending = ""
+    while True:
+      try:
+        out = self.inflater.decompress(data, DECOMPRESSED_CHUNK)
+      except zlib.error, e:
+        raise ArchiveError("corrupt gzip data ( %s )"%e)
+      self.crc = zlib.crc32(out, self.crc)
+      self.size += len(out)
+      yield out
+      if self.inflater.unused_data:
+        # end of the deflate data, followed by the trailer
+        self.pending = self.inflater.unused_data
+        self.state = "trailer"
+        return
+      # output may be left in the inflater when the chunk is full
+      data = self.inflater.unconsumed_tail
+      if not data and len(out) < DECOMPRESSED_CHUNK:
+        return
+
+  def check_trailer(self):
+    crc, size = struct.unpack("<II", self.pending[:8])
+    if crc != self.crc & 0xffffffff:
+      raise ArchiveError("gzip crc error")
+    if size != self.size & 0xffffffff:
+      raise ArchiveError("gzip length error")
+    self.pending = self.pending[8:]
+    self.state = "header"
 
-    path,mimetype = map(str.rstrip,map(str.lstrip,output.split(":")))
-    self.specs.set("mimetype",mimetype)
-    self.specs.set("mtime",os.path.getmtime(self.location))
+  def finish(self):
+    if self.state != "header" or self.pending.strip("\0"):
+      raise ArchiveError("truncated gzip stream")
+    return ""
+
+# bzip2 streams, verified by the decompressor (crc of blocks and stream)
+class Bzip2Stream:
+  def __init__(self):
+    self.decompressor = bz2.BZ2Decompressor()
+    self.ended = False
+    self.slice_size = 64
 
-    # lazy md5 computation
-    def compute_md5():
+  def update(self, data):
+    i = 0
+    while i < len(data):
+      if self.ended:
+        # another stream follows, as written by pbzip2, or zeros
+        if str(data[i:i+3]) != "BZh":
+          if str(data[i:]).strip("\0"):
+            raise ArchiveError("trailing garbage after bzip2 stream")
+          break
+        self.decompressor = bz2.BZ2Decompressor()
+        self.ended = False
+      data_slice = data[i:i+self.slice_size]
       try:
-        output=subprocess.check_output("md5sum "+self.location, shell=True)
-      except:
-        # for python 2.6
-        output=subprocess.Popen(["md5sum", self.location], stdout=subprocess.PIPE).communicate()[0]
-      md5,path = map(str.rstrip,map(str.lstrip,output.split()))
-      return md5
-    self.specs.set("md5",compute_md5)
-
-    # lazily compute sha1
-    def compute_sha1():
+        out = self.decompressor.decompress(data_slice)
+      except EOFError:
+        # the previous data ended exactly at the end of the stream
+        self.ended = True
+        continue
+      except IOError, e:
+        raise ArchiveError("corrupt bzip2 data ( %s )"%e)
+      unused = self.decompressor.unused_data
+      i += len(data_slice) - len(unused)
+      self.ended = bool(unused)
+      self.slice_size = next_slice_size(len(data_slice), len(out))
+      yield out
+
+  def finish(self):
+    if not self.ended:
       try:
-        output=subprocess.check_output("sha1sum "+self.location, shell=True)
-      except:
-        # for python 2.6
-        output=subprocess.Popen(["sha1sum", self.location], stdout=subprocess.PIPE).communicate()[0]
-      sha1,path = map(str.rstrip,map(str.lstrip,output.split()))
-      return sha1
+        self.decompressor.decompress("")
+        raise ArchiveError("truncated bzip2 stream")
+      except EOFError:
+        pass
+    return ""
+
+# xz streams, verified by the decompressor (check of blocks and index)
+class XzStream:
+  def __init__(self):
+    self.decompressor = lzma.LZMADecompressor()
+    self.slice_size = 64
+
+  def update(self, data):
+    i = 0
+    while i < len(data):
+      if self.decompressor.eof:
+        if str(data[i:i+6]) != "\xfd7zXZ\x00":
+          if str(data[i:]).strip("\0"):
+            raise ArchiveError("trailing garbage after xz stream")
+          break
+        self.decompressor = lzma.LZMADecompressor()
+      data_slice = str(data[i:i+self.slice_size])
+      try:
+        out = self.decompressor.decompress(data_slice)
+      except lzma.LZMAError, e:
+        raise ArchiveError("corrupt xz data ( %s )"%e)
+      i += len(data_slice) - len(self.decompressor.unused_data)
+      self.slice_size = next_slice_size(len(data_slice), len(out))
+      yield out
+
+  def finish(self):
+    if not self.decompressor.eof:
+      raise ArchiveError("truncated xz stream")
+    return ""
+
+class PlainStream:
+  def update(self, data):
+    yield data
+  def finish(self):
+    return ""
+
+# Tar headers are parsed as the data streams, and member data is skipped.
+# GNU long names and pax path records are used for names.
+TAR_BLOCK = 512
+class TarScanner:
+  def __init__(self, patterns=()):
+    self.patterns = patterns
+    self.found = set()
+    # None until the first header is read
+    self.is_tar = None
+    self.members = 0
+    self.ended = False
+    self.offset = 0
+    # bytes of header read so far
+    self.header = ""
+    # bytes of member data and padding to skip
+    self.skip = 0
+    # data of a GNU long name or pax header, collected until complete
+    self.meta = None
+    self.meta_size = 0
+    self.meta_type = None
+    # name of the next member, from a long name or pax header
+    self.next_name = None
+
+  def update(self, data):
+    i = 0
+    n = len(data)
+    while i < n and self.is_tar is not False and not self.ended:
+      if self.skip:
+        step = min(self.skip, n-i)
+        if self.meta is not None:
+          self.meta.append(str(data[i:i+step]))
+        self.skip -= step
+        i += step
+        if not self.skip and self.meta is not None:
+          self.end_meta()
+      else:
+        step = min(TAR_BLOCK-len(self.header), n-i)
+        self.header += str(data[i:i+step])
+        i += step
+        if len(self.header) == TAR_BLOCK:
+          self.parse_header(self.header)
+          self.header = ""
+      self.offset += step
+
+  def parse_header(self, header):
+    if header == "\0"*TAR_BLOCK:
+      self.ended = True
+      return
+    if not self.valid_checksum(header):
+      if self.is_tar is None:
+        self.is_tar = False
+        return
+      raise ArchiveError("corrupt tar header at offset %d"%(self.offset+1-TAR_BLOCK))
+    self.is_tar = True
+    size_field = header[124:136]
+    if ord(size_field[0]) & 0x80:
+      # base-256 encoding of big sizes
+      size = 0
+      for c in size_field[1:]:
+        size = size*256 + ord(c)
+    else:
+      size = int(size_field.strip(" \0") or "0", 8)
+    self.skip = (size + TAR_BLOCK - 1) // TAR_BLOCK * TAR_BLOCK
+    kind = header[156]
+    if kind in "LKxg":
+      self.meta = []
+      self.meta_size = size
+      self.meta_type = kind
+      if not self.skip:
+        self.end_meta()
+      return
+    name = header[:100].split("\0")[0]
+    if header[257:262] == "ustar" and header[345] != "\0":
+      name = header[345:500].split("\0")[0] + "/" + name
+    if self.next_name is not None:
+      name = self.next_name
+      self.next_name = None
+    self.members += 1
+    self.match(name)
+
+  def valid_checksum(self, header):
+    try:
+      checksum = int(header[148:156].strip(" \0"), 8)
+    except ValueError:
+      return False
+    unsigned = sum(bytearray(header[:148])) + 256 + sum(bytearray(header[156:]))
+    # some old tars computed the checksum with signed chars
+    signed = sum(struct.unpack("148b", header[:148])) + 256 + sum(struct.unpack("356b", header[156:]))
+    return checksum in (unsigned, signed)
+
+  def end_meta(self):
+    data = "".join(self.meta)[:self.meta_size]
+    if self.meta_type == "L":
+      self.next_name = data.split("\0")[0]
+    elif self.meta_type == "x":
+      # records are "length key=value\n"
+      i = 0
+      while i < len(data):
+        length = int(data[i:data.index(" ", i)])
+        key, _, value = data[data.index(" ", i)+1:i+length-1].partition("=")
+        if key == "path":
+          self.next_name = value
+        i += length
+    self.meta = None
+
+  def match(self, name):
+    name = name.rstrip("/")
+    if name.startswith("./"):
+      name = name[2:]
+    for pattern in self.patterns:
+      if pattern not in self.found and fnmatch.fnmatch(name, pattern):
+        self.found.add(pattern)
+
+  def finish(self):
+    if self.is_tar and not self.ended and (self.skip or self.header):
+      raise ArchiveError("truncated tar archive")
+
+# Streams a file through its decompressor and the tar scanner
+class ArchiveReader:
+  def __init__(self, path, patterns=()):
+    self.path = path
+    # decompressor, chosen from the first bytes of the file
+    self.stream = None
+    self.head = ""
+    self.tar = TarScanner(patterns)
+    self.error = None
+    # without the lzma module, xz archives are tested afterwards by xz
+    self.xz_command = False
+
+  def start(self, head):
+    if head.startswith("\x1f\x8b"):
+      return GzipStream()
+    if head.startswith("BZh"):
+      return Bzip2Stream()
+    if head.startswith("\xfd7zXZ\x00"):
+      if lzma is None:
+        self.xz_command = True
+        return None
+      return XzStream()
+    return PlainStream()
+
+  def update(self, data):
+    if self.stream is None and not self.xz_command:
+      self.head += str(data)
+      if len(self.head) < 6:
+        return
+      self.stream = self.start(self.head)
+      data = self.head
+    self.feed(data)
+
+  def feed(self, data):
+    if self.error or self.xz_command:
+      return
+    try:
+      for out in self.stream.update(data):
+        self.tar.update(out)
+    except ArchiveError, e:
+      self.error = str(e)
+
+  def specs(self):
+    if self.stream is None and not self.xz_command:
+      # file shorter than the bytes needed to detect its format
+      self.stream = self.start(self.head)
+      self.feed(self.head)
+    if self.xz_command:
+      return self.xz_specs()
+    if not self.error:
+      try:
+        self.tar.update(self.stream.finish())
+        self.tar.finish()
+      except ArchiveError, e:
+        self.error = str(e)
+    if not self.error and isinstance(self.stream, PlainStream) and not self.tar.is_tar:
+      self.error = "not a gzip, bzip2, xz or tar archive"
+    members = None
+    if self.tar.is_tar:
+      members = self.tar.members
+    return {"archive_error": self.error, "archive_members": members, "archive_found": sorted(self.tar.found)}
+
+  def xz_specs(self):
+    instrumentation.count_process()
+    p = subprocess.Popen(["xz", "--test", self.path], stdout=subprocess.PIPE, stderr=subprocess.PIPE, preexec_fn=os.setsid)
+    err = current_deadline().communicate(p, "xz --test")[1]
+    error = None
+    if p.returncode != 0:
+      error = "corrupt xz data ( %s )"%err.strip()
+    # tar members are not counted
+    return {"archive_error": error, "archive_members": None, "archive_found": []}
+
+# Mime types of local files are detected from their first bytes, for the
+# formats backups are usually in. Types are those reported by file.
+MIME_SNIFF_SIZE = 4096
+MIME_MAGIC = [
+  (0, "\x1f\x8b", "application/gzip"),
+  (0, "BZh", "application/x-bzip2"),
+  (0, "\xfd7zXZ\x00", "application/x-xz"),
+  (0, "\x28\xb5\x2f\xfd", "application/zstd"),
+  (0, "PK\x03\x04", "application/zip"),
+  (0, "PK\x05\x06", "application/zip"),
+  # openssl enc with salt
+  (0, "Salted__", "application/octet-stream"),
+  (257, "ustar", "application/x-tar"),
+]
+# first line of sql dumps
+SQL_DUMP_HEADERS = ["-- MySQL dump", "-- MariaDB dump", "-- PostgreSQL database dump", "-- PostgreSQL database cluster dump"]
+
+# returns the mime type of the file at path, or None if not recognised
+def sniff_mimetype(path):
+  f = open(path, 'rb')
+  try:
+    head = f.read(MIME_SNIFF_SIZE)
+  finally:
+    f.close()
+  instrumentation.count_bytes(len(head))
+  for offset,magic,mimetype in MIME_MAGIC:
+    if head[offset:offset+len(magic)] == magic:
+      return mimetype
+  for header in SQL_DUMP_HEADERS:
+    if head.startswith(header):
+      return "text/plain"
+  return None
+
+# Types are detected in process if possible, the others with one call to
+# file per FILE_BATCH_SIZE files.
+FILE_BATCH_SIZE = 500
+
+# iterates over (path, mime type) of paths, keeping at most a batch of
+# paths in memory
+def iter_mimetypes(paths):
+  unresolved = []
+  for p in paths:
+    try:
+      mimetype = sniff_mimetype(p)
+    except IOError:
+      mimetype = None
+    if mimetype:
+      yield p, mimetype
+      continue
+    unresolved.append(p)
+    if len(unresolved) == FILE_BATCH_SIZE:
+      for result in file_mimetypes(unresolved):
+        yield result
+      unresolved = []
+  for result in file_mimetypes(unresolved):
+    yield result
+
+# returns [(path, mime type)] of paths, as detected by file
+def file_mimetypes(paths):
+  if not paths:
+    return []
+  output = run_command(["file", "--brief", "--mime-type", "--"]+paths)
+  return [(p, mimetype.strip()) for p,mimetype in zip(paths, output.splitlines())]
+
+# Files whose type is needed are registered when specs are collected.
+# When the first type is needed, the types of all files registered are
+# detected. Matches of fileglob backups are not registered, their types
+# are detected as they are listed again, see FileglobBackup.
+class MimeTypes:
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.pending = set()
+    self.results = {}
+
+  # forget types detected, so that files are sniffed again
+  def reset(self):
+    with self.lock:
+      self.pending = set()
+      self.results = {}
+
+  def register(self, path):
+    with self.lock:
+      if path not in self.results:
+        self.pending.add(path)
+
+  def get(self, path):
+    self.register(path)
+    with self.lock:
+      if path in self.results:
+        return self.results[path]
+      pending = self.pending
+      self.pending = set()
+    # files are read without holding the lock, so that a file blocking
+    # reads (eg on a hung mount) only blocks the backup reading it, which
+    # times out
+    results = dict(iter_mimetypes(pending))
+    with self.lock:
+      self.results.update(results)
+      return self.results.get(path)
+
+mime_types = MimeTypes()
 
-    self.specs.set("sha1",compute_sha1)
+class FileBackup(Backup):
+  # true if a test needs the mime type of files
+  def needs_mimetype(self):
+    return any(isinstance(t, FiletypeTest) for t in self.tests)
+
+  def collect_specs(self):
+    # one stat gives size, mtime and identity of the file
+    def stat_file(k):
+      st = os.stat(self.location)
+      return {"size": st.st_size, "mtime": st.st_mtime, "identity": (st.st_dev, st.st_ino, st.st_size, mtime_ns(st))}
+    self.specs.provide(["size", "mtime", "identity"], stat_file)
+
+    if self.needs_mimetype():
+      mime_types.register(self.location)
+    self.specs.set("mimetype",lambda: mime_types.get(self.location))
+
+    # lazily compute digests and archive specs, all those needed by tests
+    # in one pass
+    def read_file(k):
+      algorithms = set(a for a in self.digest_algorithms() + [k] if a in LOCAL_DIGEST_ALGORITHMS and self.specs.is_pending(a))
+      archive = None
+      if self.needs_archive(k):
+        archive = ArchiveReader(self.location, self.archive_patterns())
+      if spec_cache:
+        spec_cache.count_read(self.specs.get("identity"))
+      return file_digests(self.location, algorithms, archive)
+    self.specs.provide(LOCAL_DIGEST_ALGORITHMS + ARCHIVE_SPECS, read_file)
+    self.specs.set_cacheable(LOCAL_DIGEST_ALGORITHMS)
+
+    # fingerprint of sampled blocks, with the sampling of the test
+    def sample(k):
+      sampling = [t.sampling for t in self.tests if isinstance(t, SampleDigestTest)][0]
+      return {"sample_digest": sample_fingerprint(self.location, *sampling)}
+    self.specs.provide(["sample_digest"], sample)
 
 import glob
+import fnmatch
+# Aggregates of the matches of a glob, updated as matches are found, so
+# that memory does not grow with the number of matches.
+class GlobMatches:
+  def __init__(self):
+    self.count = 0
+    self.size = 0
+    self.min_size = None
+    self.newest_mtime = None
+    self.oldest_mtime = None
+    # only used when there is one match
+    self.first = None
+  def add_match(self, match, size=None, mtime=None):
+    if self.first is None:
+      self.first = match
+    self.count += 1
+    if size is not None:
+      self.size += size
+      self.min_size = min(size, self.min_size) if self.min_size is not None else size
+    if mtime is not None:
+      self.newest_mtime = max(mtime, self.newest_mtime)
+      self.oldest_mtime = min(mtime, self.oldest_mtime) if self.oldest_mtime is not None else mtime
+
+# iterate over entries matching pattern, with the rules of glob.glob:
+# wildcards do not match across / nor hidden files. Directories are listed
+# with scandir, and the stat of an entry is done at most once.
+def iter_glob(pattern):
+  dirname, basename = os.path.split(pattern)
+  if not glob.has_magic(pattern):
+    if os.path.lexists(pattern):
+      yield ListdirEntry(dirname, basename)
+    return
+  if glob.has_magic(dirname):
+    directories = (e.path for e in iter_glob(dirname) if e.is_dir())
+  else:
+    directories = [dirname]
+  for directory in directories:
+    if not glob.has_magic(basename):
+      if os.path.lexists(os.path.join(directory, basename)):
+        yield ListdirEntry(directory, basename)
+      continue
+    try:
+      entries = scan_dir(directory or os.curdir)
+    except OSError:
+      continue
+    for entry in entries:
+      if entry.name.startswith(".") and not basename.startswith("."):
+        continue
+      if fnmatch.fnmatch(entry.name, basename):
+        if not directory:
+          # relative pattern, give paths as glob does
+          entry = ListdirEntry(directory, entry.name)
+        yield entry
+
+# specs of fileglob backups which need the stat of each match
+GLOB_STAT_SPECS = ["size", "min_match_size", "newest_match_mtime", "oldest_match_mtime"]
+
 class FileglobBackup(FileBackup):
+  # matches are counted, and stat'ed if a test needs it, in one pass.
+  # As with glob.glob, a dangling symlink is a match: it is counted
+  # whether or not the matches are stat'ed, but has no size nor mtime.
   def exists(self):
-    found = glob.glob(self.location)
-    count = len(found)
-    if count<1:
-      return False
-    else:
-      self.matches =  found
-      self.count = count
-      return True
+    self.matches = GlobMatches()
+    with_stat = any(k in self.needed_specs() for k in GLOB_STAT_SPECS)
+    for entry in iter_glob(self.location):
+      st = None
+      if with_stat:
+        try:
+          st = entry.stat()
+        except OSError:
+          pass
+      if st is not None:
+        self.matches.add_match(entry.path, st.st_size, st.st_mtime)
+      else:
+        self.matches.add_match(entry.path)
+    self.count = self.matches.count
+    return self.count>0
+  # paths of matches, listed again as they are not kept
+  def iter_matches(self):
+    return (e.path for e in iter_glob(self.location))
   def collect_specs(self):
     self.specs.set("count", self.count)
-    total_size = sum(os.path.getsize(l) for l in self.matches)
-    self.specs.set("size",total_size)
-    self.specs.set("matches",self.matches)
+    self.specs.set("size", self.matches.size)
+    self.specs.set("min_match_size", self.matches.min_size)
+    self.specs.set("newest_match_mtime", self.matches.newest_mtime)
+    self.specs.set("oldest_match_mtime", self.matches.oldest_mtime)
 
-    if self.specs.get("count")==1:
-      output=subprocess.check_output("file --mime-type "+self.location, shell=True)
-      path,mimetype = map(str.rstrip,map(str.lstrip,output.split(":")))
-      self.specs.set("mimetype",mimetype)
+    # number of matches of each mime type, detected as matches are listed
+    def mimetypes():
+      result = {}
+      for path,mimetype in iter_mimetypes(self.iter_matches()):
+        result[mimetype] = result.get(mimetype, 0) + 1
+      return result
+    self.specs.set("mimetypes",mimetypes)
+    # archive specs of all matches: the first error, the least number of
+    # members, and the patterns matched in all of them
+    def read_archives(k):
+      result = {"archive_error": None, "archive_members": None, "archive_found": None}
+      members = []
+      for path in self.iter_matches():
+        specs = file_digests(path, [], ArchiveReader(path, self.archive_patterns()))
+        if specs["archive_error"] and not result["archive_error"]:
+          result["archive_error"] = path + ": " + specs["archive_error"]
+        members.append(specs["archive_members"])
+        found = set(specs["archive_found"])
+        if result["archive_found"] is not None:
+          found &= set(result["archive_found"])
+        result["archive_found"] = sorted(found)
+      if None not in members:
+        result["archive_members"] = min(members)
+      return result
+    self.specs.provide(ARCHIVE_SPECS, read_archives)
+    if self.count==1:
+      self.specs.set("mimetype",lambda: mime_types.get(self.matches.first))
     else:
       # do not set mimetype if multiple matches
       self.specs.set("mimetype",None)
 
-import boto
+boto = LazyModule("boto")
+# Connections to s3 are shared by all backups using the same credentials
+# file, and bucket handles by all backups in the same bucket, as getting
+# a bucket validates it with a request to s3.
+# Connections are closed by BackupChecker.cleanup.
+class S3Connections:
+  def __init__(self):
+    self.lock = threading.Lock()
+    # s3_auth file -> connection
+    self.connections = {}
+    # (s3_auth file, bucket name) -> bucket
+    self.buckets = {}
+    # one lock per bucket, so that a bucket is looked up only once
+    self.bucket_locks = {}
+    self.timeouts = dict(DEFAULT_TIMEOUTS)
+    self.configured = False
+    # held while setting the boto config, as connections are made with
+    # or without holding lock
+    self.config_lock = threading.Lock()
+
+  # boto reads the socket timeout and the number of retries from its
+  # global config, so they are set once, from the timeouts of the settings
+  # (see backup_timeouts), before the first connection. The deadline of
+  # each backup still applies.
+  def configure(self, settings=None):
+    with self.config_lock:
+      self.timeouts = backup_timeouts(settings, {})
+      self.configured = False
+
+  def configure_boto(self):
+    if not boto.config.has_section("Boto"):
+      boto.config.add_section("Boto")
+    if self.timeouts["operation"] is not None:
+      boto.config.set("Boto", "http_socket_timeout", str(max(1, int(round(self.timeouts["operation"])))))
+    boto.config.set("Boto", "num_retries", str(self.timeouts["retries"]))
+    self.configured = True
+
+  def connection(self, s3_auth):
+    with self.lock:
+      if s3_auth not in self.connections:
+        self.connections[s3_auth] = self.new_connection(s3_auth)
+      return self.connections[s3_auth]
+
+  # returns a connection not shared, for use by one thread, which closes it.
+  # boto retries failed requests itself with jittered backoff.
+  def new_connection(self, s3_auth):
+    auth = yaml.load(open(s3_auth).read().__str__())
+    with self.config_lock:
+      if not self.configured:
+        self.configure_boto()
+    return boto.connect_s3(
+        aws_access_key_id= auth["access_key"],
+        aws_secret_access_key = auth["secret_key"])
+
+  def bucket(self, s3_auth, bucket_name):
+    conn = self.connection(s3_auth)
+    key = (s3_auth, bucket_name)
+    with self.lock:
+      lock = self.bucket_locks.setdefault(key, threading.Lock())
+    with lock:
+      if key not in self.buckets:
+        self.buckets[key] = conn.get_bucket(bucket_name)
+      return self.buckets[key]
+
+  def close(self):
+    with self.lock:
+      for conn in self.connections.values():
+        conn.close()
+      self.connections = {}
+      self.buckets = {}
+      self.bucket_locks = {}
+
+s3_connections = S3Connections()
+
 class S3FileBackup(Backup):
+  remote = True
   def __init__(self,yml):
     # needed to break cyclic dependency
     # move all specific behaciour to collect_specs to avoid this?
@@ -344,59 +2240,220 @@ class S3FileBackup(Backup):
     self.init_s3_object()
     Backup.__init__(self,yml)
   def init_s3_connection(self,yml):
-    s3_auth = yaml.load(open(yml["s3_auth"]).read().__str__())
-    self.conn = boto.connect_s3(
-        aws_access_key_id= s3_auth["access_key"],
-        aws_secret_access_key = s3_auth["secret_key"])
+    self.s3_auth = yml["s3_auth"]
+    self.conn = s3_connections.connection(self.s3_auth)
   def init_s3_object(self):
     bucket_name,object_name=self.location.split('/')
-    bucket=self.conn.get_bucket(bucket_name)
+    bucket=s3_connections.bucket(self.s3_auth, bucket_name)
     self.s3_object=bucket.get_key(object_name)
   def exists(self):
     return self.s3_object != None and self.s3_object.exists()
   def collect_specs(self):
     self.specs.set("size",self.s3_object.size)
     self.specs.set("mimetype",self.s3_object.content_type)
-    self.specs.set("md5",self.s3_object.md5)
-    #k.size
+    self.specs.set("etag",self.s3_object.etag.strip('"'))
     #k.last_modified
     #import time
     #time.strptime(k.last_modified, '%a, %d %b %Y %H:%M:%S %Z')
-    #k.name
-    #k.content_type
-  def cleanup(self):
-    self.conn.close()
 
-import fnmatch
+    # the etag of an object uploaded in one part, and not encrypted or
+    # encrypted with s3 managed keys, is the md5 of its content. It is not
+    # with kms keys, nor with customer keys (SSE-C) which boto does not
+    # report as encrypted.
+    etag = self.specs.get("etag")
+    if "-" not in etag and self.s3_object.encrypted in (None, "AES256") and "md5" in self.needed_specs() and not self.customer_encrypted():
+      self.specs.set("md5", etag)
+    # lazily compute digests, all those needed by tests in one download
+    def compute_digests(k):
+      algorithms = set(a for a in self.digest_algorithms() + [k] if self.specs.is_pending(a))
+      bucket_name,object_name=self.location.split('/')
+      def new_fetcher():
+        conn = s3_connections.new_connection(self.s3_auth)
+        key = conn.get_bucket(bucket_name, validate=False).new_key(object_name)
+        return (lambda start, end: key.get_contents_as_string(headers={"Range": "bytes=%d-%d"%(start, end)}), conn.close)
+      return ranged_digests(new_fetcher, self.s3_object.size, algorithms, self.part_size(), self.yml.get("workers", 4))
+    self.specs.provide([a for a in LOCAL_DIGEST_ALGORITHMS if not self.specs.has(a)], compute_digests)
+
+  # true if the object is encrypted with a key given by the client, as
+  # told by a header of the object which boto does not keep
+  def customer_encrypted(self):
+    bucket_name,object_name=self.location.split('/')
+    response = self.conn.make_request("HEAD", bucket_name, object_name)
+    response.read()
+    return response.getheader("x-amz-server-side-encryption-customer-algorithm") is not None
+
+  # size of parts downloaded, and of parts of multipart uploads
+  def part_size(self):
+    size = self.yml.get("part_size", S3_PART_SIZE)
+    if isinstance(size, basestring):
+      size = humanfriendly.parse_size(size)
+    return size
+
+# Digests of s3 objects are computed by downloading parts of part_size
+# bytes with ranged GETs, by workers threads each with its own connection.
+# Parts are hashed in order as they arrive, and workers do not get ahead
+# of the part being hashed by more than workers parts, so that memory
+# stays bounded and nothing is written to disk. Set in the yaml entry:
+#   part_size: 16MiB
+#   workers: 8
+S3_PART_SIZE = 8*1024*1024
+
+# returns a dict algorithm -> hex digest of the content of size bytes
+# returned by the functions fetch(start, end) (end included) given by
+# new_fetcher, which is called once by each worker thread and returns
+# (fetch, close), close being called when the worker is done
+def ranged_digests(new_fetcher, size, algorithms, part_size=S3_PART_SIZE, workers=4):
+  hashes = dict((a, new_hash(a)) for a in algorithms)
+  ranges = [(start, min(start+part_size, size)-1) for start in range(0, size, part_size)]
+  condition = threading.Condition()
+  # parts fetched and not yet hashed, by index
+  parts = {}
+  state = {"next": 0, "hashed": 0, "error": None}
+  def worker():
+    try:
+      fetch, close = new_fetcher()
+      try:
+        while True:
+          with condition:
+            while state["error"] is None and state["next"] < len(ranges) and state["next"] - state["hashed"] >= workers:
+              condition.wait()
+            if state["error"] is not None or state["next"] >= len(ranges):
+              return
+            i = state["next"]
+            state["next"] += 1
+          data = fetch(*ranges[i])
+          with condition:
+            parts[i] = data
+            condition.notify_all()
+      finally:
+        close()
+    except:
+      with condition:
+        state["error"] = sys.exc_info()
+        condition.notify_all()
+  threads = [threading.Thread(target=worker) for w in range(min(workers, len(ranges)))]
+  for t in threads:
+    t.daemon = True
+    t.start()
+  try:
+    for i in range(len(ranges)):
+      with condition:
+        while i not in parts and state["error"] is None:
+          condition.wait()
+        if state["error"] is not None:
+          raise state["error"][0], state["error"][1], state["error"][2]
+        data = parts.pop(i)
+        state["hashed"] = i+1
+        condition.notify_all()
+      if len(data) != ranges[i][1]-ranges[i][0]+1:
+        raise Exception("Short read of bytes %d-%d"%ranges[i])
+      for h in hashes.values():
+        h.update(data)
+      instrumentation.count_bytes(len(data))
+  finally:
+    with condition:
+      if state["error"] is None and state["hashed"] < len(ranges):
+        state["error"] = (Exception, Exception("Download stopped"), None)
+      condition.notify_all()
+    for t in threads:
+      t.join()
+  return dict((a, h.hexdigest()) for a,h in hashes.items())
+
+# returns the literal part of a glob pattern, before its first wildcard
+def glob_prefix(pattern):
+  for i,c in enumerate(pattern):
+    if c in "*?[":
+      return pattern[:i]
+  return pattern
+
+# Aggregates of the keys matching an s3 glob, see GlobMatches.
+# Listings give the last modification time of keys as 2014-06-24T08:31:51.000Z
+import calendar
+class S3GlobMatches(GlobMatches):
+  def add(self, key):
+    mtime = calendar.timegm(time.strptime(key.last_modified[:19], "%Y-%m-%dT%H:%M:%S"))
+    self.add_match(key, key.size, mtime)
+
+# Listings of buckets for s3_fileglob backups.
+# Only keys starting with the literal prefix of the pattern are listed,
+# with / as delimiter: like local globs, wildcards do not match across /.
+# Keys are matched as the listing's pages come in.
+# BackupChecker registers the patterns of all s3_fileglob entries before
+# initialising backups, so that patterns in a bucket with overlapping
+# prefixes (eg db.* and db.2014*) are matched in one listing, done with
+# the shortest prefix.
+class S3GlobListings:
+  def __init__(self):
+    self.lock = threading.Lock()
+    # (s3_auth, bucket name) -> set of patterns not matched yet
+    self.patterns = {}
+    # (s3_auth, bucket name, pattern) -> S3GlobMatches
+    self.results = {}
+    # one lock per bucket, held while listing it
+    self.bucket_locks = {}
+
+  # forget listings, so that buckets are listed again
+  def reset(self):
+    with self.lock:
+      self.patterns = {}
+      self.results = {}
+
+  def register(self, s3_auth, bucket_name, pattern):
+    with self.lock:
+      self.patterns.setdefault((s3_auth, bucket_name), set()).add(pattern)
+      self.bucket_locks.setdefault((s3_auth, bucket_name), threading.Lock())
+
+  # returns the S3GlobMatches of pattern in bucket
+  def matches(self, s3_auth, bucket, pattern):
+    self.register(s3_auth, bucket.name, pattern)
+    key = (s3_auth, bucket.name)
+    with self.bucket_locks[key]:
+      if key+(pattern,) not in self.results:
+        self.list(key, bucket, pattern)
+      return self.results[key+(pattern,)]
+
+  # list keys for the group of registered patterns overlapping pattern
+  def list(self, key, bucket, pattern):
+    with self.lock:
+      pending = sorted(self.patterns[key], key=glob_prefix)
+      prefix = glob_prefix(pattern)
+      # the group's prefix is the shortest prefix of which the pattern's
+      # prefix is an extension. Prefixes extending it follow it in the
+      # sorted list.
+      root = [glob_prefix(p) for p in pending if prefix.startswith(glob_prefix(p))][0]
+      group = [p for p in pending if glob_prefix(p).startswith(root)]
+      self.patterns[key].difference_update(group)
+    results = dict((p, S3GlobMatches()) for p in group)
+    for k in bucket.list(prefix=root, delimiter="/"):
+      # skip common prefixes, which are returned as entries without size
+      if getattr(k, "size", None) is None:
+        continue
+      for p in group:
+        if fnmatch.fnmatch(k.name, p):
+          results[p].add(k)
+    for p in group:
+      self.results[key+(p,)] = results[p]
+
+s3_listings = S3GlobListings()
+
 class S3FileglobBackup(S3FileBackup):
   def init_s3_object(self):
     bucket_name,object_name=self.location.split('/')
-    bucket=self.conn.get_bucket(bucket_name)
-
-    objects = bucket.list()
-
-    count = 0
-    matches = []
-    for key in objects:
-      if fnmatch.fnmatch(key.name,object_name):
-        count = count + 1
-        matches.append(key)
-    self.count=count
-    if count>0:
-      self.s3_objects=matches
-      return True
-    else:
-      self.s3_object = None
-      return False                   
+    bucket=s3_connections.bucket(self.s3_auth, bucket_name)
+    self.matches = s3_listings.matches(self.s3_auth, bucket, object_name)
+    self.count = self.matches.count
+    self.s3_object = self.matches.first
+    return self.count>0
 
   def collect_specs(self):
     self.specs.set("count",self.count)
-
-    total_size = sum(o.size for o in self.s3_objects)
-    self.specs.set("size",total_size)
+    self.specs.set("size",self.matches.size)
+    self.specs.set("min_match_size", self.matches.min_size)
+    self.specs.set("newest_match_mtime", self.matches.newest_mtime)
+    self.specs.set("oldest_match_mtime", self.matches.oldest_mtime)
 
     if self.specs.get("count")==1:
-      self.specs.set("mimetype",self.s3_objects[0].content_type)
+      self.specs.set("mimetype",self.s3_object.content_type)
     else:
       # do not set mimetype if multiple matches
       self.specs.set("mimetype",None)
@@ -404,173 +2461,1319 @@ class S3FileglobBackup(S3FileBackup):
   def exists(self):
     return self.count>0
 
-import paramiko
-class SshFileBackup(Backup):
+paramiko = LazyModule("paramiko")
+# One ssh connection is kept per (host, user), and shared by all backups
+# on that host: sftp sessions and command channels are opened on its
+# transport. The number of channels open at the same time on a transport
+# is capped (sshd's MaxSessions defaults to 10), configurable in the settings:
+#   ssh:
+#     max_channels: 8
+# sftp sessions are kept open after use to be reused by the next backup.
+# All connections are closed by BackupChecker.cleanup.
+class SshConnection:
+  def __init__(self, host, user, max_channels):
+    self.host = host
+    self.user = user
+    self.max_channels = max_channels
+    self.client = None
+    # true while a thread connects, the others waiting for it
+    self.connecting = False
+    # channels reserved by acquire, idle sftp sessions included
+    self.open_channels = 0
+    self.idle_sftp = []
+    self.condition = threading.Condition()
+
+  # returns the client, connecting it if needed. The connection is made
+  # without holding the condition, so that threads using channels are not
+  # blocked by it. Channels reserved on a previous connection are still
+  # counted until they are released.
+  def connect(self):
+    deadline = current_deadline()
+    with self.condition:
+      while True:
+        transport = self.client and self.client.get_transport()
+        if transport is not None and transport.is_active():
+          return self.client
+        if not self.connecting:
+          break
+        self.condition.wait()
+      self.connecting = True
+      # idle sessions were on the previous connection
+      for sftp in self.idle_sftp:
+        sftp.close()
+      self.open_channels -= len(self.idle_sftp)
+      self.idle_sftp = []
+    client = paramiko.SSHClient()
+    # FIXME
+    client.set_missing_host_key_policy( paramiko.AutoAddPolicy())
+    def connect():
+      timeout = deadline.timeout("connect")
+      start = time.time()
+      try:
+        client.connect(self.host, username=self.user, timeout=timeout, banner_timeout=timeout, auth_timeout=timeout)
+      except paramiko.SSHException:
+        # timeouts of the handshake are reported as SSHException
+        if timeout is not None and time.time() - start >= timeout:
+          raise socket.timeout()
+        raise
+    connected = False
+    try:
+      # authentication failures and bad host keys are not retried
+      deadline.retry(connect, (socket.error, EOFError, paramiko.SSHException), (paramiko.AuthenticationException, paramiko.BadHostKeyException))
+      connected = True
+    except socket.timeout:
+      raise BackupTimeout("no connection to %s within %s"%(self.host, format_timeout(deadline.timeouts["connect"])))
+    finally:
+      with self.condition:
+        if connected:
+          if self.client:
+            self.client.close()
+          self.client = client
+        self.connecting = False
+        self.condition.notify_all()
+    return client
+
+  # wait for a free channel. Returns an idle sftp session if there is one
+  # and reuse_sftp is set, otherwise reserves room for a new channel.
+  def acquire(self, reuse_sftp):
+    with self.condition:
+      while True:
+        if self.idle_sftp:
+          sftp = self.idle_sftp.pop()
+          if reuse_sftp:
+            return sftp
+          # recycle the idle session's channel
+          sftp.close()
+          return None
+        if self.open_channels < self.max_channels:
+          self.open_channels += 1
+          return None
+        self.condition.wait()
+
+  def release(self, sftp=None):
+    with self.condition:
+      if sftp is None:
+        self.open_channels -= 1
+      else:
+        self.idle_sftp.append(sftp)
+      # threads waiting in connect wait on the same condition
+      self.condition.notify_all()
+
+  # sftp sessions are closed when the deadline of the backup using them
+  # passes, and not reused after a timeout
+  @contextmanager
+  def sftp(self):
+    client = self.connect()
+    deadline = current_deadline()
+    sftp = self.acquire(True)
+    if sftp is None:
+      try:
+        sftp = client.open_sftp()
+      except:
+        self.release()
+        raise
+    sftp.get_channel().settimeout(deadline.timeout("operation"))
+    try:
+      with deadline.cancellable(sftp.close):
+        yield sftp
+      deadline.check()
+    except (IOError, OSError), e:
+      if not deadline.expired and not isinstance(e, socket.timeout):
+        # errors on remote files (eg missing) leave the session usable
+        self.release(sftp)
+        raise
+      sftp.close()
+      self.release()
+      deadline.check()
+      raise BackupTimeout("no answer from sftp on %s within %s"%(self.host, format_timeout(deadline.timeouts["operation"])))
+    except:
+      sftp.close()
+      self.release()
+      raise
+    self.release(sftp)
+
+  # run command and return the lines of its standard output
+  def run(self, command):
+    return list(self.lines(command))
+
+  # run command and iterate over the lines of its standard output as they
+  # are received. The channel is closed if no output is received within the
+  # operation timeout, or when the deadline passes.
+  def lines(self, command):
+    deadline = current_deadline()
+    self.acquire(False)
+    try:
+      timeout = deadline.timeout("operation")
+      stdin,stdout,stderr = deadline.retry(lambda: self.connect().exec_command(command, timeout=timeout), (paramiko.SSHException, EOFError))
+      try:
+        with deadline.cancellable(stdout.channel.close):
+          for line in stdout:
+            yield line
+      except socket.timeout:
+        raise BackupTimeout("no output from %s within %s"%(self.host, format_timeout(deadline.timeouts["operation"])))
+      finally:
+        stdout.channel.close()
+      # output is cut short when the channel is closed by the deadline
+      deadline.check()
+    finally:
+      self.release()
+
+  def close(self):
+    with self.condition:
+      for sftp in self.idle_sftp:
+        sftp.close()
+      self.idle_sftp = []
+      if self.client:
+        self.client.close()
+        self.client = None
+
+class SshConnectionPool:
+  def __init__(self, max_channels=8):
+    self.max_channels = max_channels
+    self.lock = threading.Lock()
+    self.connections = {}
+
+  def configure(self, settings=None):
+    settings = settings or {}
+    self.max_channels = settings.get("max_channels", self.max_channels)
+
+  def connection(self, host, user):
+    with self.lock:
+      key = (host, user)
+      if key not in self.connections:
+        self.connections[key] = SshConnection(host, user, self.max_channels)
+      return self.connections[key]
+
+  def close(self):
+    with self.lock:
+      for connection in self.connections.values():
+        connection.close()
+      self.connections = {}
+
+ssh_pool = SshConnectionPool()
+
+# Common code of backups accessed over ssh. location is host:path
+class SshBackup(Backup):
+  remote = True
   def __init__(self,yml):
     self.location = yml["location"]
-    # Initialise property to be set later on
-    self.stats = None
     self.init_sftp_connection(yml)
     Backup.__init__(self,yml)
 
-  def cleanup(self):
-    self.sftp.close()
-    self.ssh.close()
-
   def init_sftp_connection(self,yml):
-    self.ssh = paramiko.SSHClient()
-    # FIXME
-    self.ssh.set_missing_host_key_policy( paramiko.AutoAddPolicy())
     self.host,self.remote_path=self.location.split(":")
-    self.ssh.connect(self.host, username=yml["ssh_user"])
-    self.sftp=self.ssh.open_sftp()
+    self.connection = ssh_pool.connection(self.host, yml["ssh_user"])
+    # connect now so that connection errors are reported at initialisation
+    self.connection.connect()
+
+  # context manager giving an sftp session, eg:
+  #   with self.sftp() as sftp:
+  #     sftp.stat(self.remote_path)
+  def sftp(self):
+    return self.connection.sftp()
+
+# Files of ssh_file backups are probed by host: one command run on the
+# host stats a batch of the files registered for it, and another one
+# computes the digests needed for a batch, reading each file once. A batch
+# starts with the file of the backup asking for it and is bounded, so that
+# it is probed within the deadline of that backup. The remote
+# command is a python script (python3 or python must be installed on the
+# host) printing one json object per file, eg:
+#   {"path": "/backups/db.gz", "size": 1234, "mtime": 1408935615.0, "digests": {"md5": "..."}}
+# BackupChecker registers the files of all ssh_file entries and the
+# digests needed by their tests before initialising backups. Digests are
+# only computed when the first of them is needed.
+# If a file is missing from the output, eg when python is not available,
+# it is probed on its own with sftp and *sum commands.
+import pipes
+
+REMOTE_PROBE_SCRIPT = """
+import sys, os, json, hashlib
+for arg in sys.argv[1:]:
+  algorithms, path = arg.split(":", 1)
+  result = {"path": path}
+  try:
+    st = os.stat(path)
+    result["size"] = st.st_size
+    result["mtime"] = st.st_mtime
+    hashes = [(a, hashlib.new(a == "blake2" and "blake2b" or a)) for a in algorithms.split(",") if a]
+    if hashes:
+      f = open(path, "rb")
+      while True:
+        data = f.read(4 << 20)
+        if not data:
+          break
+        for a, h in hashes:
+          h.update(data)
+      f.close()
+      result["digests"] = dict((a, h.hexdigest()) for a, h in hashes)
+  except Exception as e:
+    result["error"] = str(e)
+  sys.stdout.write(json.dumps(result) + "\\n")
+  sys.stdout.flush()
+"""
+
+# maximum number of files probed by one command, to stay under the
+# command line length limit
+REMOTE_PROBE_BATCH_SIZE = 200
+# maximum number of bytes digested by one command, so that it completes
+# within the deadline of the backup waiting for it
+REMOTE_PROBE_BATCH_BYTES = 1 << 30
+
+# returns the command probing paths, paths being a dict path -> digest algorithms
+def remote_probe_command(paths):
+  args = " ".join(pipes.quote("%s:%s"%(",".join(sorted(algorithms)), path)) for path,algorithms in sorted(paths.items()))
+  script = pipes.quote(REMOTE_PROBE_SCRIPT)
+  return "for p in python3 python; do if command -v $p >/dev/null; then exec $p -c %s %s; fi; done"%(script, args)
+
+class SshProbes:
+  def __init__(self):
+    self.lock = threading.Lock()
+    # (host, user) -> dict path -> set of digest algorithms needed
+    self.paths = {}
+    # (host, user, path) -> result of probe
+    self.results = {}
+    # one lock per host, held while probing it
+    self.host_locks = {}
+
+  # forget results, so that files are probed again
+  def reset(self):
+    with self.lock:
+      self.paths = {}
+      self.results = {}
+
+  def register(self, host, user, path, algorithms=()):
+    with self.lock:
+      self.paths.setdefault((host,user), {}).setdefault(path, set()).update(algorithms)
+      return self.host_locks.setdefault((host,user), threading.Lock())
+
+  # returns the paths probed by one command: path, then other pending
+  # paths of host up to REMOTE_PROBE_BATCH_SIZE files and
+  # REMOTE_PROBE_BATCH_BYTES to digest, as far as sizes are known
+  def batch(self, host, path, pending):
+    def digested(p, algorithms):
+      return algorithms and self.results.get(host+(p,), {}).get("size", 0) or 0
+    batch = {path: pending.pop(path, set())}
+    size = digested(path, batch[path])
+    for p,algorithms in sorted(pending.items()):
+      if len(batch) >= REMOTE_PROBE_BATCH_SIZE:
+        break
+      if size + digested(p, algorithms) <= REMOTE_PROBE_BATCH_BYTES:
+        batch[p] = algorithms
+        size += digested(p, algorithms)
+    return batch
+
+  # run probes for paths of host, and store results as they are received,
+  # so that they are kept when the deadline cuts the output short
+  def probe(self, connection, paths):
+    host = (connection.host, connection.user)
+    for line in connection.lines(remote_probe_command(paths)):
+      try:
+        result = json.loads(line)
+      except ValueError:
+        continue
+      if "digests" in result:
+        # keep digests computed earlier for other algorithms
+        previous = self.results.get(host+(result["path"],), {}).get("digests", {})
+        result["digests"] = dict(previous, **result["digests"])
+      self.results[host+(result["path"],)] = result
+
+  # returns probe result of path: a dict with size and mtime, or error
+  def stat(self, connection, path):
+    host = (connection.host, connection.user)
+    with self.register(connection.host, connection.user, path):
+      if host+(path,) not in self.results:
+        with self.lock:
+          pending = self.batch(host, path, dict((p, set()) for p in self.paths[host] if host+(p,) not in self.results))
+        self.probe(connection, pending)
+      if host+(path,) not in self.results:
+        self.results[host+(path,)] = self.sftp_stat(connection, path)
+      return self.results[host+(path,)]
+
+  def digest(self, connection, path, algorithm):
+    host = (connection.host, connection.user)
+    with self.register(connection.host, connection.user, path, [algorithm]):
+      digests = self.results.get(host+(path,), {}).get("digests", {})
+      if algorithm not in digests:
+        # compute all digests still needed on the host in one go
+        with self.lock:
+          pending = {}
+          for p,algorithms in self.paths[host].items():
+            done = self.results.get(host+(p,), {}).get("digests", {})
+            missing = set(a for a in algorithms if a not in done)
+            if missing and "error" not in self.results.get(host+(p,), {}):
+              pending[p] = missing
+          pending = self.batch(host, path, pending)
+        self.probe(connection, pending)
+        digests = self.results.get(host+(path,), {}).get("digests", {})
+      if algorithm not in digests:
+        command = {"blake2": "b2sum"}.get(algorithm, algorithm+"sum")
+        digests[algorithm] = connection.run("%s %s"%(command, pipes.quote(path)))[0].split()[0]
+        self.results.setdefault(host+(path,), {})["digests"] = digests
+      return digests[algorithm]
+
+  def sftp_stat(self, connection, path):
+    try:
+      with connection.sftp() as sftp:
+        stats = sftp.stat(path)
+      return {"path": path, "size": stats.st_size, "mtime": stats.st_mtime}
+    except IOError, e:
+      return {"path": path, "error": str(e)}
+
+ssh_probes = SshProbes()
+
+class SshFileBackup(SshBackup):
+  def __init__(self,yml):
+    # Initialise property to be set later on
+    self.stats = None
+    SshBackup.__init__(self,yml)
 
   def stat_path(self):
   # get stat of path. Does not take anny argument, but uses the instance's member variable
     if self.stats == None:
-      self.stats=self.sftp.stat(self.remote_path)
+      self.stats=ssh_probes.stat(self.connection, self.remote_path)
     return self.stats
 
   def exists(self):
-    try: 
-      stats = self.stat_path()
-    except IOError, e:
-      return False
-      # if we want to be more precise in the future:
-      #if e.errno == errno.ENOENT:
-      #  return False
-    return True
+    return "error" not in self.stat_path()
 
   def collect_specs(self):
     stats = self.stat_path()
-    self.specs.set("size",stats.st_size)
-    self.specs.set("mtime", stats.st_mtime) 
+    self.specs.set("size",stats["size"])
+    self.specs.set("mtime", stats["mtime"])
     # Currently not supported by openssh (checkf-file extension)
     #with self.sftp.open(self.remote_path, 'r') as f:
     #  self.specs.set("sha1", f.check('sha1'))
     #  self.specs.set("md5", f.check('md5'))
-    # so do it manually:
+    # so do it manually, in a batch for all files of the host.
     
     # define functions for heavy computation so it is done only if needed
-    def compute_sha1():
-      stdin,stdout,stderr=self.ssh.exec_command("sha1sum "+self.remote_path)
-      sha1=stdout.readlines()[0].split()[0]
-      return sha1
-    self.specs.set("sha1", compute_sha1)
-
-    def compute_md5():
-      stdin,stdout,stderr=self.ssh.exec_command("md5sum "+self.remote_path)
-      md5=stdout.readlines()[0].split()[0]
-      return md5
-    self.specs.set("md5", compute_md5)
-
-class SshDirBackup(Backup):
-  def __init__(self,yml):
-    self.location = yml["location"]
-    self.init_sftp_connection(yml)
-    Backup.__init__(self,yml)
+    def compute_digest(k):
+      return {k: ssh_probes.digest(self.connection, self.remote_path, k)}
+    self.specs.provide(DIGEST_ALGORITHMS, compute_digest)
 
-  def init_sftp_connection(self, yml):
-    self.ssh = paramiko.SSHClient()
-    # FIXME
-    self.ssh.set_missing_host_key_policy( paramiko.AutoAddPolicy())
-    self.host,self.remote_path=self.location.split(":")
-    self.ssh.connect(self.host, username=yml["ssh_user"])
-    self.sftp=self.ssh.open_sftp()
+# Directories of ssh_dir backups are summarised by one traversal on the
+# host, done by a python script streaming a manifest as json lines: the
+# mtime of the directory first, then a summary of each top level
+# subdirectory as soon as it is walked, a summary of the other top level
+# entries, and an end marker, eg:
+#   {"mtime": 1408935615.0}
+#   {"path": "2014", "size": 40960, "entries": 12, "newest": 1408935615.0, "levels": [[1, 4096, 1408935615.0], [11, 36864, 1408935612.0]]}
+#   {"path": ".", "size": 1024, "entries": 3, "newest": 1408935600.0, "visible": 3, "levels": [[3, 1024, 1408935600.0]]}
+#   {"end": true}
+# Sizes are apparent sizes, counting hardlinked files once, as du -sb.
+# levels gives the number of entries, size and newest mtime at each depth,
+# down to the depth needed by directory_newest_entry_max_age tests.
+# The script can be tried locally with sh -c "$(remote_manifest_command(...))".
+# When directory_cache is enabled (see SpecCache), the manifest is stored
+# with the mtime of the directory, and the script stops after printing the
+# mtime if it did not change. Beware that only adding, removing or renaming
+# an entry at the top level changes that mtime: files modified in place or
+# changes in subdirectories are not seen until then.
+REMOTE_MANIFEST_SCRIPT = """
+import sys, os, json, stat
+root, depth, cached = sys.argv[1], int(sys.argv[2]), sys.argv[3]
+def out(d):
+  sys.stdout.write(json.dumps(d) + "\\n")
+  sys.stdout.flush()
+try:
+  st = os.lstat(root)
+except OSError as e:
+  out({"error": str(e)})
+  sys.exit()
+out({"mtime": st.st_mtime, "size": st.st_size})
+if str(int(round(st.st_mtime * 1e9))) == cached:
+  out({"unchanged": True, "end": True})
+  sys.exit()
+seen = set()
+def later(a, b):
+  if a is None or b > a:
+    return b
+  return a
+# every entry is counted, but the size of a hardlinked file only once
+def add(summary, d, s):
+  size = s.st_size
+  if (s.st_ino, s.st_dev) in seen:
+    size = 0
+  elif s.st_nlink > 1 and not stat.S_ISDIR(s.st_mode):
+    seen.add((s.st_ino, s.st_dev))
+  summary["entries"] += 1
+  summary["size"] += size
+  summary["newest"] = later(summary["newest"], s.st_mtime)
+  if d <= depth:
+    while len(summary["levels"]) <= d:
+      summary["levels"].append([0, 0, None])
+    level = summary["levels"][d]
+    level[0] += 1
+    level[1] += size
+    level[2] = later(level[2], s.st_mtime)
+def new_summary(path):
+  return {"path": path, "size": 0, "entries": 0, "newest": None, "levels": []}
+top = new_summary(".")
+top["visible"] = 0
+for name in os.listdir(root):
+  path = os.path.join(root, name)
+  try:
+    s = os.lstat(path)
+  except OSError:
+    continue
+  if not name.startswith("."):
+    top["visible"] += 1
+  if not stat.S_ISDIR(s.st_mode):
+    add(top, 0, s)
+    continue
+  summary = new_summary(name)
+  add(summary, 0, s)
+  stack = [(path, 1)]
+  while stack:
+    directory, d = stack.pop()
+    try:
+      names = os.listdir(directory)
+    except OSError:
+      continue
+    for n in names:
+      p = os.path.join(directory, n)
+      try:
+        s = os.lstat(p)
+      except OSError:
+        continue
+      add(summary, d, s)
+      if stat.S_ISDIR(s.st_mode):
+        stack.append((p, d + 1))
+  out(summary)
+out(top)
+out({"end": True})
+"""
 
-    
+# returns the command printing the manifest of the directory at path, with
+# levels down to depth. cached is the mtime in ns of a manifest in the cache
+def remote_manifest_command(path, depth=0, cached=None):
+  script = pipes.quote(REMOTE_MANIFEST_SCRIPT)
+  args = " ".join(pipes.quote(str(a)) for a in [path, depth, cached])
+  return "for p in python3 python; do if command -v $p >/dev/null; then exec $p -c %s %s; fi; done"%(script, args)
+
+# Summary of a directory, built from the lines of its manifest as they are
+# received, so that the manifest is not kept in memory.
+class RemoteManifest:
+  def __init__(self, depth):
+    self.depth = depth
+    self.mtime = None
+    self.error = None
+    self.ended = False
+    self.unchanged = False
+    # apparent size of the directory itself is added with its mtime
+    self.size = 0
+    self.total_entries = 0
+    self.entries_count = 0
+    self.newest = None
+    # [entries, size, newest mtime] at each depth
+    self.levels = []
+
+  def add_line(self, line):
+    try:
+      data = json.loads(line)
+    except ValueError:
+      return
+    if "error" in data:
+      self.error = data["error"]
+    if "mtime" in data:
+      self.mtime = data["mtime"]
+      # du counts the directory itself
+      self.size += data["size"]
+    if "path" in data:
+      self.size += data["size"]
+      self.total_entries += data["entries"]
+      self.newest = max(self.newest, data["newest"])
+      self.entries_count += data.get("visible", 0)
+      for d, (entries, size, newest) in enumerate(data["levels"]):
+        if len(self.levels) <= d:
+          self.levels.append([0, 0, None])
+        self.levels[d] = [self.levels[d][0]+entries, self.levels[d][1]+size, max(self.levels[d][2], newest)]
+    self.unchanged = data.get("unchanged", self.unchanged)
+    self.ended = data.get("end", self.ended)
+
+  # returns the newest mtime of entries down to depth
+  def newest_at(self, depth):
+    return max([None] + [level[2] for level in self.levels[:depth+1]])
+
+  def summary(self):
+    return {"size": self.size, "total_entries": self.total_entries, "entries_count": self.entries_count, "newest": self.newest, "levels": self.levels, "depth": self.depth}
+
+# returns the manifest of path on the host of connection, with levels down
+# to depth, from the cache if the directory's mtime did not change
+def remote_manifest(connection, path, depth=0):
+  key = "ssh://%s@%s%s"%(connection.user, connection.host, path)
+  cached = None
+  if directory_cache:
+    cached = directory_cache.stored_directory(key)
+    if cached is not None and cached[1]["depth"] < depth:
+      cached = None
+  manifest = RemoteManifest(depth)
+  for line in connection.lines(remote_manifest_command(path, depth, cached and cached[0])):
+    manifest.add_line(line)
+  if manifest.error:
+    return manifest
+  if not manifest.ended:
+    raise Exception("Incomplete manifest of %s"%key)
+  if manifest.unchanged:
+    summary = cached[1]
+  else:
+    summary = manifest.summary()
+    if directory_cache:
+      directory_cache.set_directory(key, int(round(manifest.mtime*1e9)), summary)
+      directory_cache.commit()
+  for k,v in summary.items():
+    setattr(manifest, k, v)
+  return manifest
+
+class SshDirBackup(SshBackup):
+  # specs computed from the manifest
+  manifest_specs = ["size", "entries_count", "total_entries", "newest_mtime"]
+  spec_costs = dict.fromkeys(["manifest"] + manifest_specs, COST_LISTING)
   def exists(self):
-    #FIXME
-    return True
+    try:
+      with self.sftp() as sftp:
+        self.stats = sftp.stat(self.remote_path)
+    except IOError:
+      return False
+    return stat.S_ISDIR(self.stats.st_mode)
+
+  # depth of levels needed by the tests
+  def manifest_depth(self):
+    return max([0] + [t.params.get("depth", 0) for t in self.tests if isinstance(t, DirectoryNewestEntryMaxAgeTest)])
 
+  # the directory is only traversed when a test needs one of the specs of
+  # the manifest
   def collect_specs(self):
-    # lazily compute du
-    def du_computer():
-      stdin,stdout,stderr=self.ssh.exec_command("du -sb "+self.remote_path)
-      return int(stdout.readlines()[0].split('\t')[0])
-    self.specs.set("size", du_computer )
-
-    stats = self.sftp.lstat(self.remote_path)
-    self.specs.set("mtime", stats.st_mtime)
-    stdin,stdout,stderr=self.ssh.exec_command("ls "+ self.remote_path + "| wc -l")
-    self.specs.set("entries_count", int(stdout.readlines()[0])) 
-  def cleanup(self):
-    self.sftp.close()
-    self.ssh.close()
+    self.specs.set("mtime", self.stats.st_mtime)
+    def manifest():
+      manifest = remote_manifest(self.connection, self.remote_path, self.manifest_depth())
+      if manifest.error:
+        raise Exception("Cannot walk %s ( %s )"%(self.location, manifest.error))
+      return manifest
+    self.specs.set("manifest", manifest)
+    def from_manifest(k):
+      manifest = self.specs.get("manifest")
+      return {"size": manifest.size, "entries_count": manifest.entries_count, "total_entries": manifest.total_entries, "newest_mtime": manifest.newest}
+    self.specs.provide(self.manifest_specs, from_manifest, requires=["manifest"])
 
 # Maybe (?) add handle to the file in the backup instance?
 # that would be handle to local file or to the s3 key of the backup file
 
 
 
+################################################################################
+# Git repositories are verified by reading their .pack and .idx files
+# directly, with mmap, instead of running git fsck which inflates and
+# hashes every object. For each pack:
+#   - the sha1 trailer of the pack and of its index are checked,
+#   - the index must be consistent with the pack: same number of objects,
+#     same pack checksum, offsets inside the pack, monotonic fanout table.
+# Packs are verified in parallel, hashlib releasing the GIL while hashing.
+# Refs (HEAD, loose refs and packed-refs) must point to an object found
+# in a pack index or as a loose object, possibly in an alternate object
+# directory. This does not detect a corrupt object whose pack still has
+# a valid checksum, nor missing objects reachable from refs.
+import mmap
+import bisect
+import multiprocessing
+
+class GitError(Exception):
+  pass
+
+# returns the git directory of the repository at location
+def git_dir(location):
+  dotgit = os.path.join(location, ".git")
+  if os.path.isfile(dotgit):
+    # worktrees and submodules have a file pointing to their git directory
+    path = open(dotgit).read().strip().split("gitdir: ",1)[-1]
+    return os.path.join(location, path)
+  if os.path.isdir(dotgit):
+    return dotgit
+  return location
+
+# object directories of a repository, its own and its alternates
+def git_object_dirs(gitdir):
+  dirs = [os.path.join(gitdir, "objects")]
+  alternates = os.path.join(dirs[0], "info", "alternates")
+  if os.path.isfile(alternates):
+    for line in open(alternates):
+      line = line.strip()
+      if line and not line.startswith("#"):
+        dirs.append(os.path.join(dirs[0], line))
+  return dirs
+
+def mmap_file(path):
+  f = open(path, "rb")
+  try:
+    if os.fstat(f.fileno()).st_size == 0:
+      raise GitError("%s is empty"%path)
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+  finally:
+    f.close()
+
+# sha1 of data[start:end] of an mmap, hashed by chunks
+def mmap_sha1(data, start, end):
+  h = hashlib.sha1()
+  chunk = 16*1024*1024
+  for offset in range(start, end, chunk):
+    h.update(buffer(data, offset, min(chunk, end-offset)))
+    instrumentation.count_bytes(min(chunk, end-offset))
+  return h.digest()
+
+# Index of a pack, version 1 or 2, see gitformat-pack(5)
+class PackIndex:
+  def __init__(self, path):
+    self.path = path
+    self.data = mmap_file(path)
+    if self.data[:4] == "\377tOc":
+      self.version = struct.unpack(">I", self.data[4:8])[0]
+      if self.version != 2:
+        raise GitError("%s: unsupported index version %d"%(path, self.version))
+      fanout = 8
+      self.names_offset = fanout + 1024
+      self.name_stride = 20
+    else:
+      self.version = 1
+      fanout = 0
+      # entries are a 4 bytes offset followed by the name
+      self.names_offset = fanout + 1024 + 4
+      self.name_stride = 24
+    if len(self.data) < fanout + 1024 + 40:
+      raise GitError("%s: truncated index"%path)
+    self.fanout = struct.unpack(">256I", self.data[fanout:fanout+1024])
+    self.count = self.fanout[255]
+    self.pack_checksum = self.data[-40:-20]
+
+  # sequence of the object names of the index, for bisect
+  def __len__(self):
+    return self.count
+  def __getitem__(self, i):
+    offset = self.names_offset + i*self.name_stride
+    return self.data[offset:offset+20]
+
+  def contains(self, name):
+    first = ord(name[0])
+    low = self.fanout[first-1] if first else 0
+    i = bisect.bisect_left(self, name, low, self.fanout[first])
+    return i < self.fanout[first] and self[i] == name
+
+  # offsets of objects in the pack
+  def offsets(self):
+    if self.version == 1:
+      return [struct.unpack(">I", self.data[o-4:o])[0] for o in range(self.names_offset, self.names_offset+24*self.count, 24)]
+    start = self.names_offset + 24*self.count
+    offsets = struct.unpack(">%dI"%self.count, self.data[start:start+4*self.count])
+    large_start = start + 4*self.count
+    large = [o for o in offsets if o & 0x80000000]
+    result = [o for o in offsets if not o & 0x80000000]
+    for o in large:
+      i = large_start + 8*(o & 0x7fffffff)
+      result.append(struct.unpack(">Q", self.data[i:i+8])[0])
+    return result
+
+  # returns the errors found in the index, given the size of its pack
+  def errors(self, pack_size):
+    errors = []
+    if any(a > b for a,b in zip(self.fanout, self.fanout[1:])):
+      errors.append("fanout table not sorted")
+    if self.version == 2:
+      size = 8 + 1024 + 28*self.count + 40
+      large = len(self.data) - size
+      if large < 0 or large % 8:
+        return errors + ["wrong size %d for %d objects"%(len(self.data), self.count)]
+    elif len(self.data) != 1024 + 24*self.count + 40:
+      return errors + ["wrong size %d for %d objects"%(len(self.data), self.count)]
+    if mmap_sha1(self.data, 0, len(self.data)-20) != self.data[-20:]:
+      errors.append("index checksum mismatch")
+    elif self.count and max(self.offsets()) >= pack_size - 20:
+      errors.append("object offset beyond end of pack")
+    return errors
+
+  def close(self):
+    self.data.close()
+
+# returns the errors found in the pack at path and its index
+def verify_pack(path):
+  index_path = path[:-5] + ".idx"
+  errors = []
+  try:
+    index = PackIndex(index_path)
+    try:
+      pack = mmap_file(path)
+      try:
+        if pack[:4] != "PACK" or len(pack) < 32:
+          errors.append("not a pack")
+        else:
+          version, count = struct.unpack(">II", pack[4:12])
+          if version not in (2, 3):
+            errors.append("unsupported pack version %d"%version)
+          if count != index.count:
+            errors.append("%d objects in pack, %d in index"%(count, index.count))
+          if mmap_sha1(pack, 0, len(pack)-20) != pack[-20:]:
+            errors.append("pack checksum mismatch")
+          elif index.pack_checksum != pack[-20:]:
+            errors.append("index is not the index of the pack")
+          errors += index.errors(len(pack))
+      finally:
+        pack.close()
+    finally:
+      index.close()
+  except (IOError, OSError, GitError), e:
+    errors.append(str(e))
+  return [os.path.basename(path) + ": " + e for e in errors]
+
+def git_packs(object_dir):
+  return sorted(glob.glob(os.path.join(object_dir, "pack", "*.pack")))
+
+# returns the errors found in the packs of the repository, verifying them
+# with workers threads
+def verify_git_packs(gitdir, workers):
+  packs = git_packs(os.path.join(gitdir, "objects"))
+  results = ConcurrencyLimits({"workers": workers}).map(verify_pack, packs, lambda p: {})
+  return [e for errors in results for e in errors]
+
+# returns a dict ref name -> object name (hex), for HEAD, loose refs and
+# packed refs, including the objects peeled tags point to. Symbolic refs
+# to a missing ref are given the value None.
+def git_refs(gitdir):
+  refs = {}
+  packed = os.path.join(gitdir, "packed-refs")
+  if os.path.isfile(packed):
+    name = None
+    for line in open(packed):
+      line = line.strip()
+      if line.startswith("#") or not line:
+        continue
+      if line.startswith("^"):
+        refs[name+"^{}"] = line[1:]
+      else:
+        value, name = line.split(" ", 1)
+        refs[name] = value
+  for directory, dirnames, filenames in os.walk(os.path.join(gitdir, "refs")):
+    for filename in filenames:
+      path = os.path.join(directory, filename)
+      refs[os.path.relpath(path, gitdir)] = open(path).read().strip()
+  head = os.path.join(gitdir, "HEAD")
+  if os.path.isfile(head):
+    refs["HEAD"] = open(head).read().strip()
+  # resolve symbolic refs
+  for name, value in refs.items():
+    seen = set()
+    while value is not None and value.startswith("ref: ") and value not in seen:
+      seen.add(value)
+      value = refs.get(value[5:])
+    refs[name] = value
+  return refs
+
+# returns the number of objects of the repository and the refs whose
+# object is missing
+def git_index_stats(gitdir):
+  indexes = []
+  loose_dirs = []
+  count = 0
+  try:
+    for object_dir in git_object_dirs(gitdir):
+      loose_dirs.append(object_dir)
+      for pack in git_packs(object_dir):
+        index = PackIndex(pack[:-5] + ".idx")
+        indexes.append(index)
+        if object_dir == loose_dirs[0]:
+          count += index.count
+    # loose objects of the repository
+    objects = loose_dirs[0]
+    for d in os.listdir(objects):
+      if len(d) == 2 and os.path.isdir(os.path.join(objects, d)):
+        count += len(os.listdir(os.path.join(objects, d)))
+    unresolved = []
+    for name, value in sorted(git_refs(gitdir).items()):
+      if value is None or len(value) != 40:
+        unresolved.append(name)
+        continue
+      binary = value.decode("hex")
+      if not any(index.contains(binary) for index in indexes) and not any(os.path.isfile(os.path.join(d, value[:2], value[2:])) for d in loose_dirs):
+        unresolved.append(name)
+    return {"object_count": count, "unresolved_refs": unresolved}
+  finally:
+    for index in indexes:
+      index.close()
+
 class GitBackup(Backup):
   def exists(self):
     return os.path.isdir(self.get("location"))
   def collect_specs(self):
-    try:
-      output=subprocess.check_output("git log -n 1 --format=format:%ct", cwd=self.get("location"))
-    except:
-      # for python 2.6
-      output=subprocess.Popen(["git", "log", "-n","1", "--format=format:%ct"], cwd=self.get("location"), stdout=subprocess.PIPE).communicate()[0]
-    self.specs.set("mtime",int(output))
+    def last_commit_time():
+      output=run_command(["git", "log", "-n","1", "--format=format:%ct"], cwd=self.get("location"))
+      return int(output)
+    self.specs.set("mtime",last_commit_time)
+    gitdir = git_dir(self.get("location"))
+    self.specs.set("pack_errors", lambda: verify_git_packs(gitdir, self.yml.get("workers", multiprocessing.cpu_count())))
+    self.specs.provide(["object_count", "unresolved_refs"], lambda k: git_index_stats(gitdir))
+
+# Walk of a local directory tree, computing in process what du -sb
+# reports: the apparent size of all entries, directories included, with
+# hardlinked files counted once. Entries are listed with scandir, and the
+# subdirectories of the top level are walked in parallel.
+# The walk also gives the number of entries and the newest mtime, at any
+# depth, so that tests on the directory do not walk it again.
+# When directory_cache is enabled (see SpecCache), the names of the entries
+# of each directory are stored with its mtime, and a directory whose mtime
+# did not change is not listed again. Its entries are still stat'ed, as a
+# file modified in place does not change the mtime of its directory.
+class DirectoryWalk:
+  def __init__(self, path, workers=4):
+    self.path = path.rstrip("/") or "/"
+    self.workers = workers
+    # path -> (depth, summary)
+    self.summaries = {}
+
+  # summary of the entries directly in the directory at path, whose stat
+  # result is st. Sizes of hardlinked files are kept apart to count them
+  # once in the whole tree.
+  def summarize(self, path, st):
+    names = None
+    if directory_cache:
+      names = directory_cache.get_directory(path, mtime_ns(st))
+    if names is None:
+      names = [e.name for e in scan_dir(path)]
+      if directory_cache:
+        directory_cache.set_directory(path, mtime_ns(st), names)
+    summary = {"size": st.st_size, "count": 0, "visible_count": 0, "newest": None, "newest_name": None, "subdirs": [], "hardlinks": []}
+    for name in names:
+      try:
+        entry_stat = os.lstat(os.path.join(path, name))
+      except OSError:
+        continue
+      summary["count"] += 1
+      if not name.startswith("."):
+        summary["visible_count"] += 1
+      if summary["newest"] is None or entry_stat.st_mtime > summary["newest"]:
+        summary["newest"] = entry_stat.st_mtime
+        summary["newest_name"] = name
+      if stat.S_ISDIR(entry_stat.st_mode):
+        summary["subdirs"].append(name)
+      elif entry_stat.st_nlink > 1:
+        summary["hardlinks"].append((entry_stat.st_dev, entry_stat.st_ino, entry_stat.st_size))
+      else:
+        summary["size"] += entry_stat.st_size
+    return summary
+
+  # walk the tree at path, returns dict path -> (depth, summary)
+  def walk(self, path, depth, recurse=True):
+    summaries = {}
+    pending = [(path, depth)]
+    while pending:
+      path, depth = pending.pop()
+      try:
+        summary = self.summarize(path, os.lstat(path))
+      except OSError:
+        continue
+      summaries[path] = (depth, summary)
+      if recurse:
+        pending.extend((os.path.join(path, d), depth+1) for d in summary["subdirs"])
+    if directory_cache:
+      directory_cache.commit()
+    return summaries
+
+  def run(self):
+    self.summaries = self.walk(self.path, 0, False)
+    subdirs = [os.path.join(self.path, d) for d in self.summaries[self.path][1]["subdirs"]]
+    for summaries in ConcurrencyLimits({"workers": self.workers}).map(lambda d: self.walk(d, 1), subdirs, lambda d: {}):
+      self.summaries.update(summaries)
+    return self
+
+  def size(self):
+    size = 0
+    hardlinks = {}
+    for depth, summary in self.summaries.values():
+      size += summary["size"]
+      for dev,ino,link_size in summary["hardlinks"]:
+        hardlinks[(dev,ino)] = link_size
+    return size + sum(hardlinks.values())
+
+  # number of entries directly in the directory, not counting hidden ones as ls
+  def entries_count(self):
+    return self.summaries[self.path][1]["visible_count"]
+
+  def total_entries(self):
+    return sum(summary["count"] for depth,summary in self.summaries.values())
+
+  # returns (path, mtime) of the newest entry, looking into depth levels
+  # of subdirectories, or at all levels if depth is None
+  def newest(self, depth=None):
+    newest_path, newest_time = None, None
+    for path,(d,summary) in self.summaries.items():
+      if depth is not None and d > depth:
+        continue
+      if summary["newest"] is not None and (newest_time is None or summary["newest"] > newest_time):
+        newest_path, newest_time = os.path.join(path, summary["newest_name"]), summary["newest"]
+    return (newest_path, newest_time)
 
 class DirectoryBackup(Backup):
+  # specs computed by walking the directory
+  walk_specs = ["size", "entries_count", "total_entries", "newest_mtime"]
+  spec_costs = dict.fromkeys(["walk"] + walk_specs, COST_LISTING)
   def exists(self):
     return os.path.isdir(self.get("location"))
   def collect_specs(self):
-    def du_computer():
-      try:
-        output=subprocess.check_output("du -sb", cwd=self.get("location"))
-      except:
-        # for python 2.6
-        output=subprocess.Popen(["du", "-sb"], cwd=self.get("location"), stdout=subprocess.PIPE).communicate()[0]
-      return int(output)
-    self.specs.set("size",du_computer)
-    self.specs.set("mtime",os.path.getmtime(self.get("location")))  
+    # all specs are computed by one walk of the directory
+    self.specs.set("walk", lambda: DirectoryWalk(self.get("location"), self.yml.get("workers", 4)).run())
+    def from_walk(k):
+      walk = self.specs.get("walk")
+      return {"size": walk.size(), "entries_count": walk.entries_count(), "total_entries": walk.total_entries(), "newest_mtime": walk.newest()[1]}
+    self.specs.provide(self.walk_specs, from_walk, requires=["walk"])
+    self.specs.set("mtime",lambda: os.path.getmtime(self.get("location")))
       
 
+################################################################################
+# Tests of a backup are run from the cheapest to the most expensive, as
+# given by their cost class (see Test.cost_class), and stop at the first
+# failure, so that eg a file too small is not hashed. Within a cost class,
+# tests are ordered by the time they took at previous runs, and else as in
+# the config.
+# Expensive tests share the reads done for them: specs computed by one
+# provider are computed in one pass, eg all digests and archive specs of
+# a file. When tests of the same expensive class need specs of different
+# providers, these are computed in parallel before running the tests.
+# Times taken are kept in the cache when it is enabled, so that they are
+# known from one run to the next.
+class TestCosts:
+  def __init__(self):
+    self.lock = threading.Lock()
+    # (backup name, test class name) -> seconds, None if unknown
+    self.costs = {}
+    # costs measured and not saved in the cache yet
+    self.measured = {}
+
+  def get(self, backup, test):
+    key = (backup, test)
+    with self.lock:
+      if key in self.costs:
+        return self.costs[key]
+    seconds = spec_cache and spec_cache.get_test_cost(backup, test)
+    with self.lock:
+      self.costs[key] = seconds
+    return seconds
+
+  def record(self, backup, test, seconds):
+    key = (backup, test)
+    previous = self.get(backup, test)
+    # averaged with the previous time, so that one slow run does not
+    # reorder the tests
+    if previous is not None:
+      seconds = (previous + seconds) / 2
+    with self.lock:
+      self.costs[key] = seconds
+      self.measured[key] = seconds
+
+  def save(self):
+    with self.lock:
+      measured = self.measured
+      self.measured = {}
+    if spec_cache and measured:
+      spec_cache.set_test_costs(measured)
+
+  # forget costs, which are read again from the cache
+  def reset(self):
+    with self.lock:
+      self.costs = {}
+      self.measured = {}
+
+test_costs = TestCosts()
+
+# returns the tests of backup b as a list of (cost class, test), in the
+# order in which they are to be run
+def plan_tests(b):
+  def order(item):
+    i, t = item
+    seconds = test_costs.get(b.name, t.__class__.__name__)
+    return (t.cost_class(), seconds is None, seconds, i)
+  return [(t.cost_class(), t) for i,t in sorted(enumerate(b.tests), key=order)]
+
+# compute the pending specs needed by tests of backup b in parallel, in
+# the deadline of the current thread. Errors are raised again when the
+# tests read the specs, see BackupSpecs.get.
+# Returns spec -> seconds taken to get it, including the wait for a
+# provider computing it with other specs, to be charged to the tests
+# reading it.
+def prefetch_specs(b, tests):
+  keys = []
+  for t in tests:
+    keys.extend(k for k in t.needed_specs() if b.specs.is_pending(k) and k not in keys)
+  if len(keys) <= 1:
+    return {}
+  deadline = current_deadline()
+  def get(k):
+    deadlines.current = deadline
+    with instrumentation.measure(b.yml, "prefetch", k) as measure:
+      try:
+        b.specs.get(k)
+      except Exception:
+        pass
+    return measure
+  measures = ConcurrencyLimits({"workers": len(keys)}).map(get, keys, lambda k: {})
+  instrumentation.count_nested(measures)
+  return dict((k, measure["seconds"]) for k,measure in zip(keys, measures))
+
+################################################################################
+# Backups are independent of each other, so they can be built and checked
+# in parallel. The number of backups handled at the same time is limited
+# globally, per backup kind and per host, as configured in the settings:
+#   concurrency:
+#     workers: 16
+#     per_host: 4
+#     per_kind:
+#       ssh_file: 8
+#       s3_fileglob: 2
+# With workers set to 1 (the default), backups are handled one after the
+# other in the main thread, as before.
+# returns the host a backup entry talks to, None for local backups
+def backup_host(yml):
+  kind = yml.get("kind","")
+  location = yml.get("location","")
+  if kind.startswith("ssh_"):
+    return location.split(":")[0]
+  if kind.startswith("s3_"):
+    # all entries in a bucket hit the same endpoint
+    return location.split("/")[0]
+  return None
+
+class ConcurrencyLimits:
+  def __init__(self, settings=None):
+    settings = settings or {}
+    self.workers  = settings.get("workers", 1)
+    self.per_host = settings.get("per_host")
+    self.per_kind = settings.get("per_kind", {})
+    self.lock = threading.Lock()
+    self.semaphores = {}
+
+  def semaphore(self, key, limit):
+    with self.lock:
+      if key not in self.semaphores:
+        self.semaphores[key] = threading.BoundedSemaphore(limit)
+      return self.semaphores[key]
+
+  # keys of the semaphores to hold while working on the backup.
+  # They are always taken in the same order (kind, then host) so that
+  # workers cannot deadlock each other.
+  def slot_keys(self, yml):
+    keys = []
+    kind = yml.get("kind")
+    if kind in self.per_kind:
+      keys.append(("kind",kind))
+    host = backup_host(yml)
+    if host and self.per_host:
+      keys.append(("host",host))
+    return tuple(keys)
+
+  def slots(self, keys):
+    limits = {"kind": lambda kind: self.per_kind[kind], "host": lambda host: self.per_host}
+    return [self.semaphore(key, limits[key[0]](key[1])) for key in keys]
+
+  # take all slots without blocking, returns false if one is not free
+  def try_acquire(self, slots):
+    for n,s in enumerate(slots):
+      if not s.acquire(False):
+        for taken in reversed(slots[:n]):
+          taken.release()
+        return False
+    return True
+
+  def run(self, f, item, yml):
+    slots = self.slots(self.slot_keys(yml))
+    for s in slots:
+      s.acquire()
+    try:
+      return f(item)
+    finally:
+      for s in reversed(slots):
+        s.release()
+
+  # apply f to all items, returning results in the order of items,
+  # whatever the order in which they complete.
+  # yml_of gives the yaml config of an item, used to find its limits.
+  def map(self, f, items, yml_of=lambda i: i):
+    items = list(items)
+    if self.workers <= 1 or len(items) <= 1:
+      return [self.run(f, item, yml_of(item)) for item in items]
+
+    results = [None]*len(items)
+    errors = []
+    # items waiting, grouped by the slots they need, so that workers skip
+    # the items of a kind or host at its limit instead of waiting for it
+    # while items of other hosts are waiting
+    groups = {}
+    for i,item in enumerate(items):
+      groups.setdefault(self.slot_keys(yml_of(item)), collections.deque()).append((i,item))
+    condition = threading.Condition()
+
+    # returns the first item whose slots are free, with its slots, None
+    # if there is none. Called with condition held.
+    def next_item():
+      for keys in sorted(groups, key=lambda keys: groups[keys][0][0]):
+        slots = self.slots(keys)
+        if self.try_acquire(slots):
+          i,item = groups[keys].popleft()
+          if not groups[keys]:
+            del groups[keys]
+          return i, item, slots
+      return None
+
+    def worker():
+      while True:
+        with condition:
+          task = None
+          while groups and not errors:
+            task = next_item()
+            if task:
+              break
+            # wait for a worker to release its slots
+            condition.wait()
+        if task is None:
+          return
+        i,item,slots = task
+        try:
+          results[i] = f(item)
+        except:
+          errors.append(sys.exc_info())
+        finally:
+          for s in reversed(slots):
+            s.release()
+          with condition:
+            condition.notify_all()
+
+    threads = [threading.Thread(target=worker) for n in range(min(self.workers, len(items)))]
+    for t in threads:
+      t.daemon = True
+      t.start()
+    for t in threads:
+      # join with a timeout so that the main thread stays interruptible
+      while t.isAlive():
+        t.join(1)
+    if errors:
+      # re-raise the first error with its original traceback
+      raise errors[0][0], errors[0][1], errors[0][2]
+    return results
+
 # for notifications
-import smtplib
-from email.mime.text import MIMEText
+smtplib = LazyModule("smtplib")
+email_mime_text = LazyModule("email.mime.text")
 class BackupChecker:
-  def __init__(self,config_file):
+  # with build false, the config is read but backups are not initialised
+  def __init__(self,config_file,build=True):
     # Read config and initialise backup instances
-    self.config = yaml.load(Template(file=config_file).__str__())
-    self.backups= [self.init_backup(b) for b in self.config['backups']]
+    self.config = yaml.load(render_template(config_file))
+    self.limits = ConcurrencyLimits(self.setting("concurrency"))
+    ssh_pool.configure(self.setting("ssh"))
+    s3_connections.configure(self.setting("timeouts"))
+    self.init_cache(config_file)
+    self.backups = []
+    if build:
+      self.backups = self.build(self.config['backups'])
+  # initialise backups of the yaml entries given
+  def build(self, ymls):
+    self.register_batches(ymls)
+    return self.limits.map(self.init_backup, ymls)
+  # register entries whose data is collected in batches, so that the
+  # first backup of a batch collects the data of all of them.
+  def register_batches(self, ymls):
+    for b in ymls:
+      if b["kind"]=="s3_fileglob":
+        bucket_name,object_name=b["location"].split('/')
+        s3_listings.register(b["s3_auth"], bucket_name, object_name)
+      elif b["kind"]=="ssh_file":
+        host,path=b["location"].split(":")
+        algorithms=[k for k in (b.get("tests") or {}) if k in DIGEST_ALGORITHMS]
+        ssh_probes.register(host, b["ssh_user"], path, algorithms)
+  def write_measures(self):
+    settings = self.setting("instrumentation") or {}
+    if "jsonl" in settings:
+      instrumentation.write_jsonl(settings["jsonl"])
+    if "prometheus" in settings:
+      instrumentation.write_prometheus(settings["prometheus"])
+  def init_cache(self, config_file):
+    global spec_cache, directory_cache
+    settings = self.setting("cache")
+    for cache in set([spec_cache, directory_cache]):
+      if cache:
+        cache.close()
+    spec_cache = directory_cache = None
+    if settings is None and not self.setting("directory_cache"):
+      return
+    settings = settings or {}
+    path = settings.get("path", os.path.join(os.path.dirname(os.path.abspath(config_file)), ".backup_checker.sqlite"))
+    cache = SpecCache(path, settings.get("max_entries", 100000))
+    if self.setting("cache") is not None:
+      spec_cache = cache
+    if self.setting("directory_cache"):
+      directory_cache = cache
+  # get value for key in the settings section of the yaml config
+  def setting(self, key, default=None):
+    settings = self.config.get("settings") or {}
+    return settings.get(key, default)
   def init_backup(self,yml):
     # Find class and instanciate it with its yml config
-    name = yml["kind"].title().replace("_","")+"Backup"
-    klass = globals()[name]
-    return klass(yml)
+    klass = backup_class(yml["kind"])
+    # the deadline covers both the construction and the check
+    deadline = Deadline(backup_timeouts(self.setting("timeouts"), yml))
+    def construct():
+      with instrumentation.measure(yml, "construct"):
+        return klass(yml)
+    try:
+      backup = deadline.run(construct)
+    except BackupTimeout, e:
+      backup = TimedOutBackup(yml, str(e))
+    backup.elapsed += deadline.used
+    backup.deadline = deadline
+    return backup
 
   def check_backup(self,b):
     # Check one backup
-    if b.is_skipped():
+    if b.is_skipped() or b.is_timeout():
       return
+    def check():
+      with instrumentation.measure(b.yml, "check"):
+        self.run_tests(b)
+    start = b.deadline.used
+    try:
+      b.deadline.run(check)
+    except BackupTimeout, e:
+      b.set_timeout(str(e))
+    b.elapsed += b.deadline.used - start
+
+  def run_tests(self,b):
     # INIT
-    # i is index, l length of validators list
+    # tests in the order planned, see plan_tests
+    # i is index, l length of tests list
+    tests=plan_tests(b)
     i=0
-    l=len(b.tests)
-    
-    # INV : 
+    l=len(tests)
+    # time spent computing the specs of the tests beforehand
+    prefetched={}
+
+    # INV :
     #  0<=i<l
-    #  for 0<=j<i,   b.validators[j] was tested
-    while i<l and not b.is_invalid():
-      t=b.tests[i]
+    #  for 0<=j<i,   tests[j] was tested
+    while i<l and not b.is_invalid() and not b.is_timeout():
+      cost,t=tests[i]
+      # specs of expensive tests of the same class are computed together
+      if cost>=COST_FULL_READ and (i==0 or tests[i-1][0]!=cost):
+        prefetched = prefetch_specs(b, [u for c,u in tests[i:] if c==cost])
       # if the check fails; we set the backup as invalid
       # and loop will stop
       if not t.check():
         b.set_invalid()
+      seconds = t.seconds + sum(prefetched.get(k, 0) for k in t.needed_specs())
+      test_costs.record(b.name, t.__class__.__name__, seconds)
       i=i+1
-    # if we went through the whole list without invalidating it, the 
+    # if we went through the whole list without invalidating it, the
     # backup can be validated
     if i==l and not b.is_invalid():
       b.set_valid()
 
     
   def check(self):
-    for i,backup in enumerate(self.backups):
-      self.check_backup(backup)
+    self.limits.map(self.check_backup, self.backups, lambda b: b.yml)
     if all( (backup.status=="valid" or backup.status=="skipped") for backup in self.backups):
         # success action. FIXME: add possible success actions
       pass
@@ -578,12 +3781,12 @@ class BackupChecker:
       # error actions
       # send mail
       if self.config["settings"]["notifications"]["mail_on_error"]:
-        self.notify(self.config["settings"]["notifications"]["mail_to"],"Backup error",str(bc) )
+        self.notify(self.config["settings"]["notifications"]["mail_to"],"Backup error",str(self) )
 
   def notify(self,recipients,subject,body):
     s = smtplib.SMTP(self.config["settings"]["notifications"]["smtp_server"], self.config["settings"]["notifications"]["smtp_port"])
     #s.set_debuglevel(1)
-    msg = MIMEText(body)
+    msg = email_mime_text.MIMEText(body)
     sender = self.config["settings"]["notifications"]["sender"]
     msg['Subject'] = subject
     msg['From'] = sender
@@ -593,6 +3796,13 @@ class BackupChecker:
   def cleanup(self):
     for backup in self.backups:
       backup.cleanup()
+    self.write_measures()
+    test_costs.save()
+    ssh_pool.close()
+    s3_connections.close()
+    for cache in set([spec_cache, directory_cache]):
+      if cache:
+        cache.close()
 
   def __str__(self):
     s = "BackupChecker results\n"
@@ -600,15 +3810,424 @@ class BackupChecker:
     for b in self.backups:
       s+=str(b)
       s+="\n"
+    if spec_cache:
+      s+=spec_cache.summary()
     return s
   def to_html(self, filename="results"):
-      html = Template(file="report.tpl", searchList=[{"bc":self}]).__str__()
+      html = render_template("report.tpl", searchList=[{"bc":self}])
       f = open(filename+'_'+ time.strftime('%Y-%m-%d') + '.html', 'w')
       f.write(html)
       f.close
 
-bc=BackupChecker(sys.argv[1])
-bc.check()
-bc.cleanup()
-print(bc)
-bc.to_html()
+################################################################################
+# Streaming mode, started with --stream, for configs with too many entries
+# to be held in memory. The template is rendered to a temporary file, from
+# which backup entries are parsed one by one, and checked by chunks:
+#   streaming:
+#     chunk: 100
+#     jsonl: /var/log/backup_checker/results.jsonl
+# Backups of a chunk are built and checked in parallel as configured in
+# concurrency, then their results are written, and they are dropped. The
+# report is written as it goes: text on the standard output, html to the
+# usual file, and json lines to the jsonl file if set, eg:
+#   {"name": "db1", "kind": "file", "location": "/backups/db1.gz", "status": "valid", "elapsed": 0.02, "messages": [[true, "File type correct ( ... )."]]}
+# The settings must come before the backups in the config file, keys
+# following the backups are a configuration error.
+import itertools
+import re
+
+# Cheetah transaction writing the rendered template to a file, instead of
+# building it in memory
+class FileTransaction:
+  def __init__(self, f):
+    self.f = f
+  def response(self):
+    return self
+  def write(self, s):
+    self.f.write(s)
+
+# yields (key, value) of the mapping at the root of the yaml document in
+# path, except for key sequence_key whose items are yielded one by one as
+# (sequence_key, item). If until_sequence is set, stops at sequence_key.
+def iter_yaml_mapping(path, sequence_key, until_sequence=False):
+  stream = open(path)
+  loader = yaml.Loader(stream)
+  try:
+    # stream and document start, and start of the root mapping
+    for i in range(3):
+      loader.get_event()
+    while not loader.check_event(yaml.MappingEndEvent):
+      key = loader.construct_document(loader.compose_node(None, None))
+      if key != sequence_key or not loader.check_event(yaml.SequenceStartEvent):
+        yield key, loader.construct_document(loader.compose_node(None, None))
+        continue
+      if until_sequence:
+        return
+      loader.get_event()
+      while not loader.check_event(yaml.SequenceEndEvent):
+        yield key, loader.construct_document(loader.compose_node(None, None))
+      loader.get_event()
+  finally:
+    loader.dispose()
+    stream.close()
+
+# returns the keys of the root mapping of the yaml document in path that
+# follow key. They are found from the lines starting with a key, without
+# parsing the document.
+def root_keys_after(path, key):
+  keys = []
+  found = False
+  for line in open(path):
+    match = re.match(r"""([^\s#'"-][^:]*|'[^']*'|"[^"]*")\s*:(\s|$)""", line)
+    if not match:
+      continue
+    if found:
+      keys.append(match.group(1).strip("'\""))
+    found = found or match.group(1).strip("'\"") == key
+  return keys
+
+class StreamingBackupChecker(BackupChecker):
+  def __init__(self, config_file):
+    self.rendered = tempfile.NamedTemporaryFile(suffix=".yml")
+    load_template(config_file).respond(trans=FileTransaction(self.rendered))
+    self.rendered.flush()
+    following = root_keys_after(self.rendered.name, "backups")
+    if following:
+      raise Exception("Configuration Error, %s must come before backups in streaming mode"%", ".join(following))
+    self.config = dict(iter_yaml_mapping(self.rendered.name, "backups", until_sequence=True))
+    self.limits = ConcurrencyLimits(self.setting("concurrency"))
+    ssh_pool.configure(self.setting("ssh"))
+    s3_connections.configure(self.setting("timeouts"))
+    self.init_cache(config_file)
+    self.backups = []
+    settings = self.setting("streaming") or {}
+    self.chunk = settings.get("chunk", 100)
+    self.jsonl = settings.get("jsonl")
+    # backups checked and failed, and text of the first failures, for the
+    # notification
+    self.checked = 0
+    self.failures = 0
+    self.failed = []
+
+  def entries(self):
+    return (item for key,item in iter_yaml_mapping(self.rendered.name, "backups") if key == "backups")
+
+  def check(self, filename="results"):
+    template = load_template("report.tpl", searchList=[{"bc":self}])
+    html = open(filename+'_'+ time.strftime('%Y-%m-%d') + '.html', 'w')
+    html.write(template.header())
+    # logs are written after the table of the html report
+    logs = tempfile.TemporaryFile()
+    jsonl = None
+    if self.jsonl:
+      jsonl = open(self.jsonl, "a")
+    prometheus = None
+    if "prometheus" in (self.setting("instrumentation") or {}):
+      prometheus = PrometheusTextfile(self.setting("instrumentation")["prometheus"])
+    print("BackupChecker results")
+    print("---------------------")
+    entries = self.entries()
+    while True:
+      chunk = list(itertools.islice(entries, self.chunk))
+      if not chunk:
+        break
+      backups = self.build(chunk)
+      self.limits.map(self.check_backup, backups, lambda b: b.yml)
+      for b in backups:
+        b.cleanup()
+        self.report(b, html, template, logs, jsonl)
+      # forget data collected in batches for the chunk
+      s3_listings.reset()
+      ssh_probes.reset()
+      mime_types.reset()
+      test_costs.save()
+      test_costs.reset()
+      if prometheus:
+        prometheus.add(instrumentation.records)
+      if "jsonl" in (self.setting("instrumentation") or {}):
+        instrumentation.write_jsonl(self.setting("instrumentation")["jsonl"])
+      instrumentation.reset()
+    if spec_cache:
+      print(spec_cache.summary())
+    html.write(template.logs_header())
+    logs.seek(0)
+    for line in logs:
+      html.write(line)
+    logs.close()
+    html.write(template.footer())
+    html.close()
+    if jsonl:
+      jsonl.close()
+    if prometheus:
+      prometheus.close()
+    notifications = self.setting("notifications") or {}
+    if self.failures and notifications.get("mail_on_error"):
+      body = "".join(self.failed)
+      if self.failures > len(self.failed):
+        body += "... and %d other failed backups\n"%(self.failures - len(self.failed))
+      self.notify(notifications["mail_to"], "Backup error", body)
+
+  def report(self, b, html, template, logs, jsonl):
+    text = str(b)+"\n"
+    sys.stdout.write(text)
+    sys.stdout.flush()
+    logs.write(text)
+    html.write(template.row(b))
+    if jsonl:
+      jsonl.write(json.dumps({"name": b.name, "kind": b.kind, "location": b.location, "status": b.status, "elapsed": b.elapsed, "messages": b.messages})+"\n")
+    self.checked += 1
+    if b.status not in ["valid", "skipped"]:
+      self.failures += 1
+      if len(self.failed) < 100:
+        self.failed.append(text)
+
+  def cleanup(self):
+    ssh_pool.close()
+    s3_connections.close()
+    for cache in set([spec_cache, directory_cache]):
+      if cache:
+        cache.close()
+    self.rendered.close()
+
+################################################################################
+# Daemon mode, started with --daemon, keeps running and checks each backup
+# on its own schedule, set in its yaml entry by one of:
+#   interval: 6h
+#   cron: "30 4 * * 1-5"
+# and defaulting to the daemon's interval in the settings:
+#   daemon:
+#     interval: 1d
+#     settle: 30s
+# days_of_week still restricts the days a backup is checked.
+# Local file, fileglob and directory backups are also checked when inotify
+# reports that a file landed, once no event was seen for the settle time
+# (pyinotify is needed for this, otherwise backups are only checked on
+# schedule).
+# Connections and caches are kept between checks. The config is rendered
+# again when it is modified and when the date changes, as locations often
+# depend on the date. Measures and reports are written after each round
+# of checks, and a mail is sent when a backup stops being valid. Errors
+# in a round, eg in a config being edited, are written to stderr and the
+# daemon goes on.
+
+# Schedule from a cron expression: minute hour day-of-month month day-of-week,
+# with *, lists, ranges and steps, eg "*/15 8-18 * * 1,3,5"
+from datetime import datetime, timedelta
+class CronSchedule:
+  RANGES = [(0,59), (0,23), (1,31), (1,12), (0,6)]
+  def __init__(self, expression):
+    fields = expression.split()
+    if len(fields) != 5:
+      raise Exception("Configuration Error, invalid cron expression %s"%expression)
+    self.restricted = [f != "*" for f in fields]
+    self.minutes, self.hours, self.days, self.months, self.weekdays = [self.parse(f, r) for f,r in zip(fields, self.RANGES)]
+    # sunday can be written 7
+    if 7 in self.weekdays:
+      self.weekdays.add(0)
+
+  def parse(self, field, value_range):
+    values = set()
+    for part in field.split(","):
+      step = 1
+      if "/" in part:
+        part, step = part.split("/")
+        step = int(step)
+      if part == "*":
+        low, high = value_range
+      elif "-" in part:
+        low, high = map(int, part.split("-"))
+      else:
+        low = high = int(part)
+      values.update(range(low, high+1, step))
+    return values
+
+  def day_matches(self, t):
+    # as in cron, if both days of month and of week are restricted, either matches
+    day = t.day in self.days
+    weekday = t.isoweekday()%7 in self.weekdays
+    if self.restricted[2] and self.restricted[4]:
+      return day or weekday
+    return day and weekday
+
+  # returns the first time matching after timestamp after
+  def next_time(self, after):
+    t = datetime.fromtimestamp(after).replace(second=0, microsecond=0) + timedelta(minutes=1)
+    # a matching time is found within a few years at most
+    limit = t + timedelta(days=4*366)
+    while t < limit:
+      if t.month not in self.months:
+        t = (t.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+      elif not self.day_matches(t):
+        t = t.replace(hour=0, minute=0) + timedelta(days=1)
+      elif t.hour not in self.hours:
+        t = t.replace(minute=0) + timedelta(hours=1)
+      elif t.minute not in self.minutes:
+        t = t + timedelta(minutes=1)
+      else:
+        return time.mktime(t.timetuple())
+    raise Exception("Configuration Error, cron expression never matches")
+
+class IntervalSchedule:
+  def __init__(self, interval):
+    self.interval = interval
+  def next_time(self, after):
+    return after + self.interval
+
+# parse a duration in seconds, or with a unit as in 6h
+def parse_timespan(value):
+  if isinstance(value, (int, float)):
+    return value
+  return humanfriendly.parse_timespan(value)
+
+import traceback
+class BackupDaemon:
+  def __init__(self, config_file):
+    self.config_file = config_file
+    self.condition = threading.Condition()
+    # entry name -> time of next check
+    self.next_times = {}
+    # entry name -> latest backup checked
+    self.latest = {}
+    self.notifier = None
+    self.load()
+
+  # render the config and set up schedules and watches for its entries
+  def load(self):
+    self.config_mtime = os.path.getmtime(self.config_file)
+    self.config_date = date.today()
+    self.checker = BackupChecker(self.config_file, build=False)
+    settings = self.checker.setting("daemon") or {}
+    self.interval = parse_timespan(settings.get("interval", 86400))
+    self.settle = parse_timespan(settings.get("settle", 30))
+    self.entries = self.checker.config['backups']
+    names = set(yml["name"] for yml in self.entries)
+    with self.condition:
+      for name in self.next_times.keys():
+        if name not in names:
+          del self.next_times[name]
+      for yml in self.entries:
+        # entries not known yet are checked immediately
+        self.next_times.setdefault(yml["name"], time.time())
+    self.latest = dict((k,b) for k,b in self.latest.items() if k in names)
+    self.watch()
+
+  def schedule(self, yml):
+    if "cron" in yml:
+      return CronSchedule(yml["cron"])
+    return IntervalSchedule(parse_timespan(yml.get("interval", self.interval)))
+
+  def reload_if_needed(self):
+    if os.path.getmtime(self.config_file) != self.config_mtime or date.today() != self.config_date:
+      self.load()
+
+  # check backup entry named name in settle seconds, the check being
+  # pushed back by each event until writes stop
+  def trigger(self, name):
+    with self.condition:
+      self.next_times[name] = time.time()+self.settle
+      self.condition.notify()
+
+  # directory to watch and function telling if an event path concerns the entry
+  def watch_target(self, yml):
+    location = yml["location"]
+    if yml["kind"] == "file":
+      return os.path.dirname(location), lambda path: path == location
+    if yml["kind"] == "fileglob" and glob_prefix(os.path.dirname(location)) == os.path.dirname(location):
+      return os.path.dirname(location), lambda path: fnmatch.fnmatch(path, location)
+    if yml["kind"] == "directory":
+      return location.rstrip("/"), lambda path: True
+    return None, None
+
+  def watch(self):
+    try:
+      import pyinotify
+    except ImportError:
+      return
+    if self.notifier:
+      self.notifier.stop()
+    targets = {}
+    for yml in self.entries:
+      directory, matches = self.watch_target(yml)
+      if directory and os.path.isdir(directory):
+        targets.setdefault(directory, []).append((yml["name"], matches))
+    daemon = self
+    class Handler(pyinotify.ProcessEvent):
+      def process_default(self, event):
+        for name, matches in targets.get(event.path.rstrip("/"), []):
+          if matches(event.pathname):
+            daemon.trigger(name)
+    manager = pyinotify.WatchManager()
+    mask = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO
+    for directory in targets:
+      manager.add_watch(directory, mask)
+    self.notifier = pyinotify.ThreadedNotifier(manager, Handler())
+    self.notifier.daemon = True
+    self.notifier.start()
+
+  # wait until entries are due, and return them
+  def due(self):
+    with self.condition:
+      while True:
+        now = time.time()
+        due = [yml for yml in self.entries if self.next_times[yml["name"]] <= now]
+        if due:
+          for yml in due:
+            self.next_times[yml["name"]] = self.schedule(yml).next_time(now)
+          return due
+        # wake up at least every minute to reload the config if needed
+        self.condition.wait(min([60] + [t - now for t in self.next_times.values()]))
+        return []
+
+  def check(self, ymls):
+    # data collected in batches is collected again
+    s3_listings.reset()
+    ssh_probes.reset()
+    mime_types.reset()
+    backups = self.checker.build(ymls)
+    self.checker.limits.map(self.checker.check_backup, backups, lambda b: b.yml)
+    for backup in backups:
+      backup.cleanup()
+      previous = self.latest.get(backup.name)
+      self.latest[backup.name] = backup
+      failed = backup.status not in ["valid", "skipped"]
+      was_valid = previous is None or previous.status in ["valid", "skipped"]
+      notifications = self.checker.setting("notifications") or {}
+      if failed and was_valid and notifications.get("mail_on_error"):
+        self.checker.notify(notifications["mail_to"], "Backup error: "+backup.name, str(backup))
+    # report latest results of all entries, in config order
+    self.checker.backups = [self.latest[yml["name"]] for yml in self.entries if yml["name"] in self.latest]
+    self.checker.write_measures()
+    instrumentation.reset()
+    test_costs.save()
+    self.checker.to_html()
+
+  def run(self):
+    while True:
+      try:
+        self.reload_if_needed()
+        ymls = self.due()
+        if ymls:
+          self.check(ymls)
+      except Exception:
+        sys.stderr.write("%s: error in daemon round\n"%time.ctime())
+        traceback.print_exc()
+        # do not spin on an error repeated at each round
+        time.sleep(60)
+
+if __name__ == "__main__":
+  if sys.argv[1] == "--daemon":
+    BackupDaemon(sys.argv[2]).run()
+  if sys.argv[1] == "--stream":
+    bc=StreamingBackupChecker(sys.argv[2])
+    bc.check()
+    bc.cleanup()
+    sys.exit()
+  if sys.argv[1] == "--fingerprint":
+    # record at backup time the fingerprint checked by sample_digest tests
+    print(sample_fingerprint(sys.argv[2], *[int(a) for a in sys.argv[3:]]))
+    sys.exit()
+  bc=BackupChecker(sys.argv[1])
+  bc.check()
+  bc.cleanup()
+  print(bc)
+  bc.to_html()
@@ -1,9 +1,13 @@
+## The report is made of the parts defined below, so that the streaming
+## mode (check.py --stream) can write it as backups are checked.
+#def header
 <html>
 <head>
 <title>BackupChecker Report <%=time.strftime('%Y')%>-<%=time.strftime('%m')%>-<%=time.strftime('%d')%></title>
 <style>
 tr.valid {background-color: #90EE90;}
 tr.invalid {background-color: red;}
+tr.timeout {background-color: orange;}
 </style>
 </head>
 <body>
@@ -27,19 +31,32 @@ if ( diff > 1000 * 60 *60 * 24 ) {
   <tr>
     <th>Backup</th>
     <th>Status</th>
+    <th>Time</th>
   </tr>
-#for $backup in $bc.backups
+#end def
+#def row($backup)
   <tr class="$backup.status">
     <td>$backup.name</td>
     <td>$backup.status</td>
+    <td>$backup.elapsed_text()</td>
   </tr>
-#end for
+#end def
+#def logs_header
 </table>
 
 <h2>Detailed Logs</h2>
 <pre>
-$bc
+#end def
+#def footer
 </pre>
 </body>
 </html>
 
+#end def
+$header#slurp
+#for $backup in $bc.backups
+$row($backup)#slurp
+#end for
+$logs_header#slurp
+$bc
+$footer#slurp
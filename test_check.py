@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+
+# Tests of the local backends of check.py, on temporary trees.
+#   python -m unittest test_check
+
+import unittest
+import os
+import shutil
+import tempfile
+import subprocess
+import time
+import check
+
+# a temporary directory, removed after each test
+class TreeTestCase(unittest.TestCase):
+  def setUp(self):
+    self.root = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.root)
+
+  def path(self, *names):
+    return os.path.join(self.root, *names)
+
+  def write(self, name, content):
+    if not os.path.isdir(os.path.dirname(self.path(name))):
+      os.makedirs(os.path.dirname(self.path(name)))
+    with open(self.path(name), "w") as f:
+      f.write(content)
+
+# a dangling symlink matches as with glob.glob, without failing the
+# listing of directories when it is at a wildcard level
+class DanglingSymlinkGlobTest(TreeTestCase):
+  def setUp(self):
+    TreeTestCase.setUp(self)
+    self.write("2014/db.gz", "x"*10)
+    self.write("2015/db.gz", "x"*20)
+    os.symlink(self.path("missing"), self.path("2016"))
+    os.symlink(self.path("missing.gz"), self.path("2015", "web.gz"))
+
+  def backup(self, pattern, tests):
+    return check.FileglobBackup({"name": pattern, "kind": "fileglob", "location": self.path(pattern), "tests": tests})
+
+  def test_listdir_entry(self):
+    entry = check.ListdirEntry(self.root, "2016")
+    self.assertFalse(entry.is_dir())
+    self.assertFalse(entry.is_file())
+    self.assertFalse(entry.is_dir(follow_symlinks=False))
+
+  def test_iter_glob(self):
+    for pattern in ["*/db.gz", "*/*", "20*", "2015/*.gz"]:
+      matches = sorted(e.path for e in check.iter_glob(self.path(pattern)))
+      self.assertEqual(matches, sorted(check.glob.glob(self.path(pattern))))
+
+  # the count does not depend on the other tests configured
+  def test_count(self):
+    self.assertEqual(self.backup("2015/*.gz", {"count": 2}).tests[0].check(), True)
+    b = self.backup("2015/*.gz", {"count": 2, "match_minsize": 1})
+    self.assertEqual([t.check() for t in b.tests], [True, True])
+    self.assertEqual(b.specs.get("size"), 20)
+
+# the manifest command of ssh_dir backups, run locally, gives the same
+# specs as the walk of a local directory
+class RemoteManifestTest(TreeTestCase):
+  def setUp(self):
+    TreeTestCase.setUp(self)
+    self.write("2014/01/db.gz", "x"*10)
+    self.write("2014/02/db.gz", "x"*20)
+    self.write("2015/db.gz", "x"*30)
+    self.write(".hidden", "x"*40)
+    self.write("README", "x"*50)
+    # hardlinked files are counted as entries, their size only once
+    os.link(self.path("2015/db.gz"), self.path("2014/db.gz"))
+    os.link(self.path("README"), self.path("2015/README"))
+    os.symlink(self.path("missing"), self.path("2015/latest"))
+
+  # the remote environment does not have the python path of the tests
+  def manifest(self, depth):
+    env = dict((k,v) for k,v in os.environ.items() if k != "PYTHONPATH")
+    process = subprocess.Popen(["sh", "-c", check.remote_manifest_command(self.root, depth)], stdout=subprocess.PIPE, env=env)
+    manifest = check.RemoteManifest(depth)
+    for line in process.stdout:
+      manifest.add_line(line)
+    process.wait()
+    self.assertTrue(manifest.ended)
+    return manifest
+
+  def test_walk(self):
+    walk = check.DirectoryWalk(self.root).run()
+    manifest = self.manifest(1)
+    self.assertEqual(manifest.size, walk.size())
+    self.assertEqual(manifest.total_entries, walk.total_entries())
+    self.assertEqual(manifest.entries_count, walk.entries_count())
+    self.assertEqual(manifest.newest, walk.newest()[1])
+    self.assertEqual(manifest.newest_at(1), walk.newest(1)[1])
+    self.assertEqual([level[0] for level in manifest.levels], [4, 6])
+
+# a provider failing is called once, its specs raise the same error
+class SpecErrorTest(unittest.TestCase):
+  def setUp(self):
+    self.specs = check.BackupSpecs()
+    self.calls = []
+
+  def fail(self, k):
+    self.calls.append(k)
+    raise IOError("read error")
+
+  def test_provider(self):
+    self.specs.provide(["md5", "sha1"], self.fail)
+    self.assertRaises(IOError, self.specs.get, "md5")
+    self.assertRaises(IOError, self.specs.get, "sha1")
+    self.assertRaises(IOError, self.specs.get, "md5")
+    self.assertEqual(self.calls, ["md5"])
+
+  def test_requires(self):
+    self.specs.set("identity", lambda: self.fail("identity"))
+    self.specs.provide(["md5"], lambda k: {"md5": "0"*32}, requires=["identity"])
+    self.assertRaises(IOError, self.specs.get, "md5")
+    self.assertRaises(IOError, self.specs.get, "identity")
+    self.assertRaises(IOError, self.specs.get, "md5")
+    self.assertEqual(self.calls, ["identity"])
+
+# specs computed beforehand are charged to the tests reading them
+class PrefetchTest(unittest.TestCase):
+  class Backup:
+    yml = {}
+  class Test:
+    def __init__(self, reads):
+      self.reads = reads
+    def needed_specs(self):
+      return self.reads
+
+  def test_seconds(self):
+    b = self.Backup()
+    b.specs = check.BackupSpecs()
+    def read(k):
+      time.sleep(0.2)
+      return {"md5": "0", "sha1": "1"}
+    b.specs.provide(["md5", "sha1"], read)
+    b.specs.set("members", lambda: 3)
+    seconds = check.prefetch_specs(b, [self.Test(["md5"]), self.Test(["sha1", "members"])])
+    self.assertEqual(sorted(seconds.keys()), ["md5", "members", "sha1"])
+    # both wait for the same read
+    self.assertTrue(seconds["md5"] >= 0.2 and seconds["sha1"] >= 0.2)
+    self.assertTrue(seconds["members"] < 0.2)
+
+if __name__ == "__main__":
+  unittest.main()
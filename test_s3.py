@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+
+# Tests of the s3 backends of check.py against moto, an in process s3
+# stand-in (pip install "moto<2"). They are skipped without it.
+#   python -m unittest test_s3
+
+import unittest
+import hashlib
+import os
+import tempfile
+import StringIO
+import check
+
+try:
+  import boto
+  from moto import mock_s3_deprecated
+  from moto.s3.models import s3_backend
+except ImportError:
+  mock_s3_deprecated = None
+
+# a mocked bucket holding keys, recording the prefixes it is listed with
+class S3TestCase(unittest.TestCase):
+  keys = {}
+  def setUp(self):
+    self.mock = mock_s3_deprecated()
+    self.mock.start()
+    self.bucket = boto.connect_s3("test", "test").create_bucket("backups")
+    for name,content in self.keys.items():
+      self.bucket.new_key(name).set_contents_from_string(content)
+    self.listed = []
+    list_bucket = self.bucket.list
+    def record(prefix="", delimiter=""):
+      self.listed.append(prefix)
+      return list_bucket(prefix=prefix, delimiter=delimiter)
+    self.bucket.list = record
+
+  def tearDown(self):
+    self.mock.stop()
+
+@unittest.skipIf(mock_s3_deprecated is None, "moto not installed")
+class S3GlobListingsTest(S3TestCase):
+  keys = {
+    "db.2013-12-31.gz": "x"*10,
+    "db.2014-01-01.gz": "x"*20,
+    "db.2014-01-02.gz": "x"*30,
+    "db.old/db.2012-01-01.gz": "x"*40,
+    "web.2014-01-01.tgz": "x"*50,
+  }
+
+  def setUp(self):
+    S3TestCase.setUp(self)
+    self.listings = check.S3GlobListings()
+
+  def matches(self, pattern):
+    return self.listings.matches("auth", self.bucket, pattern)
+
+  # overlapping patterns registered beforehand are matched in one
+  # listing, with the shortest prefix
+  def test_prefix_grouping(self):
+    for pattern in ["db.2014*", "db.*", "web.*"]:
+      self.listings.register("auth", "backups", pattern)
+    self.assertEqual(self.matches("db.2014*").count, 2)
+    self.assertEqual(self.listed, ["db."])
+    self.assertEqual(self.matches("db.*").count, 3)
+    self.assertEqual(self.listed, ["db."])
+    self.assertEqual(self.matches("web.*").count, 1)
+    self.assertEqual(self.listed, ["db.", "web."])
+
+  def test_overlapping_patterns(self):
+    for pattern in ["db.*", "db.2014-01-0[12].gz"]:
+      self.listings.register("auth", "backups", pattern)
+    all_dumps = self.matches("db.*")
+    dumps_2014 = self.matches("db.2014-01-0[12].gz")
+    self.assertEqual((all_dumps.count, all_dumps.size, all_dumps.min_size), (3, 60, 10))
+    self.assertEqual((dumps_2014.count, dumps_2014.size, dumps_2014.min_size), (2, 50, 20))
+    self.assertEqual(len(self.listed), 1)
+
+  # a pattern not registered is listed on its own
+  def test_unregistered_pattern(self):
+    self.assertEqual(self.matches("web.*").count, 1)
+    self.assertEqual(self.listed, ["web."])
+
+  # with / as delimiter, wildcards do not match across /, as in local
+  # globs: keys below db.old/ are not listed by db.*
+  def test_delimiter(self):
+    self.assertEqual(self.matches("db.*").count, 3)
+    self.assertEqual(self.matches("db.old/*").count, 1)
+    self.assertEqual(self.matches("db.old/*").size, 40)
+
+  def test_reset(self):
+    self.matches("db.*")
+    self.listings.reset()
+    self.matches("db.*")
+    self.assertEqual(self.listed, ["db.", "db."])
+
+# s3_file backups of keys of the bucket
+class S3FileTestCase(S3TestCase):
+  def setUp(self):
+    S3TestCase.setUp(self)
+    fd, self.s3_auth = tempfile.mkstemp(suffix=".yml")
+    os.write(fd, "access_key: test\nsecret_key: test\n")
+    os.close(fd)
+
+  def tearDown(self):
+    check.s3_connections.close()
+    os.remove(self.s3_auth)
+    S3TestCase.tearDown(self)
+
+  def backup(self, name, tests, **yml):
+    yml.update({"name": name, "kind": "s3_file", "location": "backups/"+name, "s3_auth": self.s3_auth, "tests": tests})
+    return check.S3FileBackup(yml)
+
+@unittest.skipIf(mock_s3_deprecated is None, "moto not installed")
+class RangedDigestsTest(S3FileTestCase):
+  content = os.urandom(10000)
+  keys = {"db.gz": content}
+
+  def setUp(self):
+    S3FileTestCase.setUp(self)
+    self.closed = []
+
+  # fetches ranges of db.gz with a connection of its own, failing on
+  # the range starting at fail
+  def new_fetcher(self, fail=None):
+    key = boto.connect_s3("test", "test").get_bucket("backups").get_key("db.gz")
+    def fetch(start, end):
+      if start == fail:
+        raise IOError("connection reset")
+      return key.get_contents_as_string(headers={"Range": "bytes=%d-%d"%(start, end)})
+    return fetch, lambda: self.closed.append(key)
+
+  def test_digests(self):
+    digests = check.ranged_digests(self.new_fetcher, len(self.content), ["md5", "sha1"], 3000, 3)
+    self.assertEqual(digests, {"md5": hashlib.md5(self.content).hexdigest(), "sha1": hashlib.sha1(self.content).hexdigest()})
+    self.assertEqual(len(self.closed), 3)
+
+  def test_error(self):
+    self.assertRaises(IOError, check.ranged_digests, lambda: self.new_fetcher(fail=6000), len(self.content), ["md5"], 3000, 3)
+    self.assertEqual(len(self.closed), 3)
+
+  def test_backup(self):
+    b = self.backup("db.gz", {"sha1": hashlib.sha1(self.content).hexdigest(), "sha256": "0"*64}, part_size="4KB")
+    self.assertEqual(b.status, "unchecked")
+    self.assertEqual([t.__class__.__name__ for t in b.tests if not t.check()], ["Sha256Test"])
+
+# moto does not encrypt objects, the headers s3 gives for encrypted objects
+# are set as metadata of the keys, which moto returns as headers
+@unittest.skipIf(mock_s3_deprecated is None, "moto not installed")
+class EncryptedEtagTest(S3FileTestCase):
+  content = os.urandom(10000)
+  keys = {"plain.gz": content, "sse-s3.gz": content, "sse-kms.gz": content, "sse-c.gz": content}
+  headers = {
+    "sse-s3.gz": ("x-amz-server-side-encryption", "AES256"),
+    "sse-kms.gz": ("x-amz-server-side-encryption", "aws:kms"),
+    "sse-c.gz": ("x-amz-server-side-encryption-customer-algorithm", "AES256"),
+  }
+
+  def setUp(self):
+    S3FileTestCase.setUp(self)
+    for name,(header,value) in self.headers.items():
+      s3_backend.get_object("backups", name).metadata[header] = value
+
+  # the md5 is taken from the etag only if it is the md5 of the content
+  def test_md5(self):
+    md5 = hashlib.md5(self.content).hexdigest()
+    for name,from_etag in [("plain.gz", True), ("sse-s3.gz", True), ("sse-kms.gz", False), ("sse-c.gz", False)]:
+      b = self.backup(name, {"md5": md5})
+      self.assertEqual(b.specs.is_pending("md5"), not from_etag, name)
+      self.assertTrue(b.tests[0].check(), name)
+
+@unittest.skipIf(mock_s3_deprecated is None, "moto not installed")
+class MultipartEtagTest(S3FileTestCase):
+  keys = {"small.gz": "x"*100}
+
+  # db.gz is uploaded in parts of 5MiB, the minimum allowed by s3
+  def setUp(self):
+    S3FileTestCase.setUp(self)
+    upload = self.bucket.initiate_multipart_upload("db.gz")
+    for i,size in enumerate([5 << 20, 5 << 20, 1000]):
+      upload.upload_part_from_file(StringIO.StringIO("x"*size), i+1)
+    upload.complete_upload()
+
+  def check(self, name, params):
+    b = self.backup(name, {"multipart_etag": params})
+    return b.tests[0].check()
+
+  def test_part_size(self):
+    self.assertTrue(self.check("db.gz", {"part_size": "5MiB"}))
+    self.assertFalse(self.check("db.gz", {"part_size": "8MiB"}))
+    self.assertFalse(self.check("db.gz", {"part_size": 16 << 20}))
+
+  def test_single_part(self):
+    self.assertTrue(self.check("small.gz", {}))
+    self.assertTrue(self.check("small.gz", {"part_size": 100}))
+    self.assertFalse(self.check("small.gz", {"part_size": 10}))
+
+  def test_etag(self):
+    etag = self.bucket.get_key("db.gz").etag.strip('"')
+    self.assertTrue(etag.endswith("-3"))
+    self.assertTrue(self.check("db.gz", {"etag": etag}))
+    self.assertFalse(self.check("db.gz", {"etag": etag[:-1]+"2"}))
+
+if __name__ == "__main__":
+  unittest.main()